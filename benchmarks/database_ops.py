@@ -0,0 +1,154 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+# Measures the operations per second of core.database on a synthetic database, and
+# get_reactions written as a subquery and as a JOIN
+# Usage: python benchmarks/database_ops.py [repository root]
+# Pointing it at a checkout of an older commit gives the numbers to compare with
+
+import os
+import sys
+import random
+import sqlite3
+import tempfile
+from time import perf_counter
+
+if len(sys.argv) > 1:
+    root = os.path.abspath(sys.argv[1])
+
+else:
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, root)
+
+from core import database
+
+
+SUBQUERY = (
+    "SELECT reaction, role_id FROM reactionroles WHERE reactionrole_id = (SELECT"
+    " reactionrole_id FROM messages WHERE message_id = ?);"
+)
+JOIN = (
+    "SELECT reactionroles.reaction, reactionroles.role_id FROM messages JOIN"
+    " reactionroles ON messages.reactionrole_id = reactionroles.reactionrole_id"
+    " WHERE messages.message_id = ?;"
+)
+
+
+def fill(path, messages, guilds, mappings_per_message):
+    # Creates the tables of the oldest supported schema, without indexes
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute(
+            "CREATE TABLE messages ('message_id' INT, 'channel' INT,"
+            " 'reactionrole_id' INT, 'guild_id' INT);"
+        )
+        conn.execute(
+            "CREATE TABLE reactionroles ('reactionrole_id' INT, 'reaction'"
+            " NVCARCHAR, 'role_id' INT);"
+        )
+        conn.execute("CREATE TABLE admins ('role_id' INT, 'guild_id' INT);")
+        conn.executemany(
+            "INSERT INTO messages values(?, ?, ?, ?);",
+            [
+                (message_id, message_id % 500, message_id, message_id % guilds)
+                for message_id in range(1, messages + 1)
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO reactionroles values(?, ?, ?);",
+            [
+                (message_id, f"emoji{mapping}", message_id * 10 + mapping)
+                for message_id in range(1, messages + 1)
+                for mapping in range(mappings_per_message)
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO admins values(?, ?);",
+            [
+                (guild_id * 10 + admin, guild_id)
+                for guild_id in range(guilds)
+                for admin in range(3)
+            ],
+        )
+
+    conn.close()
+
+
+def rate(operation, count):
+    start = perf_counter()
+    for _ in range(count):
+        operation()
+
+    return count / (perf_counter() - start)
+
+
+def main():
+    random.seed(0)
+    folder = tempfile.mkdtemp()
+    path = f"{folder}/ops.db"
+    fill(path, 2000, 100, 5)
+    db = database.Database(path)
+
+    def message_id():
+        return random.randint(1, 2000)
+
+    def guild_id():
+        return random.randrange(100)
+
+    def admins():
+        db.add_admin(123, 1)
+        db.remove_admin(123, 1)
+
+    results = {
+        "exists": rate(lambda: db.exists(message_id()), 5000),
+        "get_reactions": rate(lambda: db.get_reactions(message_id()), 2000),
+        "get_admins": rate(lambda: db.get_admins(guild_id()), 5000),
+        "add+remove_admin": rate(admins, 500),
+    }
+    conn = sqlite3.connect(path)
+    results["subquery (raw SQL)"] = rate(
+        lambda: conn.execute(SUBQUERY, (message_id(),)).fetchall(), 2000
+    )
+    results["JOIN (raw SQL)"] = rate(
+        lambda: conn.execute(JOIN, (message_id(),)).fetchall(), 2000
+    )
+    conn.close()
+    print(f"ops/s on 2k messages / 10k mappings ({root}):")
+    for name, value in results.items():
+        print(f"- {name}: {value:,.0f}")
+
+    # Removing a guild with 3k of 20k reaction-role messages
+    path = f"{folder}/guild.db"
+    fill(path, 20000, 7, 5)
+    db = database.Database(path)
+    start = perf_counter()
+    db.remove_guild(0)
+    print(f"- remove_guild of 3k menus out of 20k: {perf_counter() - start:.3f} s")
+
+
+if __name__ == "__main__":
+    main()
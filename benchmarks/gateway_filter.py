@@ -0,0 +1,143 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Feeds a synthetic stream of reaction payloads through the gateway parsers with
+# and without the reaction filter and prints the events per second
+# Usage: python benchmarks/gateway_filter.py [events] [managed messages]
+
+import os
+import sys
+import random
+import asyncio
+from time import perf_counter
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.gateway import REACTION_EVENTS, ReactionGatewayFilter
+
+
+class PartialEmoji:
+    def __init__(self, data):
+        self.id = int(data["id"]) if data["id"] else None
+        self.name = data["name"]
+        self.animated = data.get("animated", False)
+
+
+class RawReactionActionEvent:
+    def __init__(self, data, emoji, event_type):
+        self.message_id = int(data["message_id"])
+        self.channel_id = int(data["channel_id"])
+        self.user_id = int(data["user_id"])
+        self.guild_id = int(data["guild_id"])
+        self.emoji = emoji
+        self.event_type = event_type
+        # discord.py copies the member payload of reaction adds
+        self.member = dict(data["member"]) if "member" in data else None
+
+
+def connection_parsers(loop, handled):
+    # Stand-ins for the discord.py parsers, they build the event objects and
+    # schedule one listener coroutine per event like Client.dispatch does
+    async def listener(event):
+        handled.append(event.message_id)
+
+    def make_parser(event_type):
+        def parse(data):
+            emoji = PartialEmoji(data["emoji"])
+            event = RawReactionActionEvent(data, emoji, event_type)
+            loop.create_task(listener(event))
+
+        return parse
+
+    return {event: make_parser(event) for event in REACTION_EVENTS}
+
+
+def payloads(count, managed, share):
+    payloads = []
+    for index in range(count):
+        if random.random() < share:
+            message_id = random.choice(managed)
+
+        else:
+            message_id = 10 ** 17 + index
+
+        payloads.append(
+            (
+                REACTION_EVENTS[index % 2],
+                {
+                    "message_id": str(message_id),
+                    "channel_id": "1",
+                    "user_id": str(index),
+                    "guild_id": "1",
+                    "emoji": {"id": None, "name": "\N{THUMBS UP SIGN}"},
+                    "member": {"roles": [], "nick": None, "user": {"id": str(index)}},
+                },
+            )
+        )
+
+    return payloads
+
+
+async def run(stream, managed, use_filter):
+    loop = asyncio.get_running_loop()
+    handled = []
+    parsers = connection_parsers(loop, handled)
+    gateway_filter = ReactionGatewayFilter(managed.__contains__)
+    if use_filter:
+        gateway_filter.install(parsers)
+
+    start = perf_counter()
+    for index, (event, data) in enumerate(stream):
+        parsers[event](data)
+        # Lets the scheduled listeners run like the gateway loop does between messages
+        if index % 1000 == 999:
+            await asyncio.sleep(0)
+
+    expected = gateway_filter.passed if use_filter else len(stream)
+    while len(handled) < expected:
+        await asyncio.sleep(0)
+
+    return len(stream) / (perf_counter() - start), len(handled)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    random.seed(0)
+    managed = list(range(1, message_count + 1))
+    managed_set = set(managed)
+    print(f"{count} events, {message_count} managed messages")
+    for share in (0.01, 0.5):
+        stream = payloads(count, managed, share)
+        unfiltered, _ = asyncio.run(run(stream, managed_set, False))
+        filtered, handled = asyncio.run(run(stream, managed_set, True))
+        print(
+            f"{share:.0%} managed: {unfiltered:,.0f} ev/s unfiltered, {filtered:,.0f}"
+            f" ev/s filtered ({filtered / unfiltered:.1f}x, {handled} dispatched)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -24,30 +24,30 @@ SOFTWARE.
 
 
 import os
+from time import time
 from shutil import copy
 from sys import platform, exit as shutdown
 
 import discord
 from discord.ext import commands
 
-from core import database, github
-
 import bot_util as util
+import bot_tasks
 
 bot = util.get_bot()
 
 activities = util.activities
-db = database.Database(util.db_file)
+db = util.db
 
 bot.remove_command("help")
 
 
 @bot.command(name="new")
 async def new(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
         # Starts setup process and the bot starts to listen to the user in that channel
         # For future prompts (see: "async def on_message(message)")
-        started = db.start_creation(
+        started = await db.start_creation(
             ctx.message.author.id, ctx.message.channel.id, ctx.message.guild.id
         )
         if started:
@@ -68,7 +68,7 @@ async def new(ctx):
 
 @bot.command(name="abort")
 async def abort(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
         # Aborts setup process
         aborted = db.abort(ctx.message.author.id, ctx.message.channel.id)
         if aborted:
@@ -86,7 +86,7 @@ async def abort(ctx):
 
 @bot.command(name="edit")
 async def edit_selector(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
         # Reminds user of formatting if it is wrong
         msg_values = ctx.message.content.split()
         if len(msg_values) < 2:
@@ -140,30 +140,17 @@ async def edit_selector(ctx):
                 channel = await util.getchannel(channel_id)
                 msg_values = ctx.message.content.split(" // ")
                 selector_msg_number = msg_values[1]
-                all_messages = db.fetch_messages(channel_id)
+                message_to_edit_id = None
+                if selector_msg_number.isdigit():
+                    message_to_edit_id = await db.get_message_by_number(
+                        channel_id, int(selector_msg_number)
+                    )
 
-                if isinstance(all_messages, Exception):
+                if isinstance(message_to_edit_id, Exception):
                     await util.system_notification(
                         ctx.message.guild.id,
                         "Database error when fetching"
-                        f" messages:\n```\n{all_messages}\n```",
-                    )
-                    return
-
-                counter = 1
-                if all_messages:
-                    message_to_edit_id = None
-                    for msg_id in all_messages:
-                        # Loop through all msg_ids and stops when the counter matches the user input
-                        if str(counter) == selector_msg_number:
-                            message_to_edit_id = msg_id
-                            break
-
-                        counter += 1
-
-                else:
-                    await ctx.send(
-                        "You selected a reaction-role message that does not exist."
+                        f" messages:\n```\n{message_to_edit_id}\n```",
                     )
                     return
 
@@ -203,6 +190,7 @@ async def edit_selector(ctx):
                     else:
                         await old_msg.edit(content=selector_msg_new_body, embed=None)
 
+                    await db.set_titles([(util.message_title(old_msg), old_msg.id)])
                     await ctx.send("Message edited.")
 
                 except discord.HTTPException as e:
@@ -227,7 +215,7 @@ async def edit_selector(ctx):
 
 @bot.command(name="reaction")
 async def edit_reaction(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
         msg_values = ctx.message.content.split()
         mentioned_roles = ctx.message.role_mentions
         mentioned_channels = ctx.message.channel_mentions
@@ -278,29 +266,20 @@ async def edit_reaction(ctx):
                 await ctx.send("You need to mention a role to attach to the reaction.")
                 return
 
-        all_messages = db.fetch_messages(channel.id)
-        if isinstance(all_messages, Exception):
+        message_to_edit_id = None
+        if message_number.isdigit():
+            message_to_edit_id = await db.get_message_by_number(
+                channel.id, int(message_number)
+            )
+
+        if isinstance(message_to_edit_id, Exception):
             await util.system_notification(
                 ctx.message.guild.id,
-                f"Database error when fetching messages:\n```\n{all_messages}\n```",
+                "Database error when fetching messages:"
+                f"\n```\n{message_to_edit_id}\n```",
             )
             return
 
-        counter = 1
-        if all_messages:
-            message_to_edit_id = None
-            for msg_id in all_messages:
-                # Loop through all msg_ids and stops when the counter matches the user input
-                if str(counter) == message_number:
-                    message_to_edit_id = msg_id
-                    break
-
-                counter += 1
-
-        else:
-            await ctx.send("You selected a reaction-role message that does not exist.")
-            return
-
         if message_to_edit_id:
             message_to_edit = await channel.fetch_message(int(message_to_edit_id))
 
@@ -324,7 +303,7 @@ async def edit_reaction(ctx):
                 )
                 return
 
-            react = db.add_reaction(message_to_edit.id, role.id, reaction)
+            react = await db.add_reaction(message_to_edit.id, role.id, reaction)
             if isinstance(react, Exception):
                 await util.system_notification(
                     ctx.message.guild.id,
@@ -348,7 +327,7 @@ async def edit_reaction(ctx):
                 await ctx.send("Invalid reaction.")
                 return
 
-            react = db.remove_reaction(message_to_edit.id, reaction)
+            react = await db.remove_reaction(message_to_edit.id, reaction)
             if isinstance(react, Exception):
                 await util.system_notification(
                     ctx.message.guild.id,
@@ -363,9 +342,61 @@ async def edit_reaction(ctx):
         await ctx.send("You do not have an admin role.")
 
 
+@bot.command(name="reconcile")
+async def reconcile_reactions(ctx):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
+        msg_values = ctx.message.content.split()
+        if len(msg_values) < 3 or not ctx.message.channel_mentions:
+            await ctx.send(
+                "Type:\n```\n"
+                f"{util.prefix}reconcile #channelname MESSAGE_NUMBER\n```\nto give and"
+                " remove the roles of a reaction-role message according to its"
+                f" current reactions. Use `{util.prefix}edit #channelname` to see the"
+                " message numbers."
+            )
+            return
+
+        channel = ctx.message.channel_mentions[0]
+        message_id = None
+        if msg_values[2].isdigit():
+            message_id = await db.get_message_by_number(channel.id, int(msg_values[2]))
+
+        if isinstance(message_id, Exception):
+            await util.system_notification(
+                ctx.message.guild.id,
+                f"Database error when fetching messages:\n```\n{message_id}\n```",
+            )
+            return
+
+        if not message_id:
+            await ctx.send(
+                "Select a valid reaction-role message number (i.e. the number"
+                f" to the left of the reaction-role message content in"
+                f" `{util.prefix}edit #channelname`)."
+            )
+            return
+
+        stats = {"added": 0, "removed": 0, "failed": 0, "rest_calls": 0}
+        changes = await bot_tasks.reconcile_message(
+            message_id, channel.id, ctx.guild.id, stats
+        )
+        await bot_tasks.apply_corrections(changes, stats)
+        await ctx.send(
+            f"Done. {stats['added']} roles added and {stats['removed']} roles removed."
+            + (
+                f" {stats['failed']} role changes could not be made."
+                if stats["failed"]
+                else ""
+            )
+        )
+
+    else:
+        await ctx.send("You do not have an admin role.")
+
+
 @bot.command(name="systemchannel")
 async def set_systemchannel(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
         global system_channel
         msg = ctx.message.content.split()
         mentioned_channels = ctx.message.channel_mentions
@@ -401,7 +432,7 @@ async def set_systemchannel(ctx):
                 util.config.write(configfile)
 
         elif channel_type == "server":
-            add_channel = db.add_systemchannel(guild_id, target_channel)
+            add_channel = await db.add_systemchannel(guild_id, target_channel)
 
             if isinstance(add_channel, Exception):
                 await util.system_notification(
@@ -507,7 +538,7 @@ async def remove_activity(ctx):
 
 @bot.command(name="help")
 async def hlp(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
         await ctx.send(
             "**Reaction Role Messages**\n"
             f"- `{prefix}new` starts the creation process for a new"
@@ -519,6 +550,8 @@ async def hlp(ctx):
             " role message.\n"
             f"- `{prefix}reaction` adds or removes a reaction from an existing"
             " reaction role message.\n"
+            f"- `{prefix}reconcile` gives and removes the roles of a reaction role"
+            " message according to its current reactions.\n"
             f"- `{prefix}colour` changes the colour of the embeds of new and newly"
             " edited reaction role messages.\n"
             "**Activities**\n"
@@ -551,7 +584,8 @@ async def hlp(ctx):
             f"- `{prefix}update` updates the bot and restarts it. Only works on"
             " `git clone` installations running on GNU/Linux.\n"
             f"- `{prefix}version` reports the bot's current version and the latest"
-            " available one from GitHub.\n\n"
+            " available one from GitHub.\n"
+            f"- `{prefix}stats` shows internal cache and performance counters.\n\n"
             f"{botname} is running version {util.__version__} of Reaction Light. You can"
             " find more resources, submit feedback, and report bugs at: "
             "<https://github.com/Scuwr/reaction-light>"
@@ -565,7 +599,7 @@ async def hlp(ctx):
 @commands.has_permissions(administrator=True)
 async def add_admin(ctx, role: discord.Role):
     # Adds an admin role ID to the database
-    add = db.add_admin(role.id, ctx.guild.id)
+    add = await db.add_admin(role.id, ctx.guild.id)
 
     if isinstance(add, Exception):
         await util.system_notification(
@@ -587,7 +621,7 @@ async def add_admin_error(ctx, error):
 @commands.has_permissions(administrator=True)
 async def remove_admin(ctx, role: discord.Role):
     # Removes an admin role ID from the database
-    remove = db.remove_admin(role.id, ctx.guild.id)
+    remove = await db.remove_admin(role.id, ctx.guild.id)
 
     if isinstance(remove, Exception):
         await util.system_notification(
@@ -609,7 +643,7 @@ async def remove_admin_error(ctx, error):
 @commands.has_permissions(administrator=True)
 async def list_admin(ctx):
     # Lists all admin IDs in the database, mentioning them if possible
-    admin_ids = db.get_admins(ctx.guild.id)
+    admin_ids = await db.get_admins(ctx.guild.id)
 
     if isinstance(admin_ids, Exception):
         await util.system_notification(
@@ -633,21 +667,125 @@ async def list_admin(ctx):
 
 @bot.command(name="version")
 async def print_version(ctx):
-    if util.isadmin(ctx.message.author, ctx.guild.id):
-        latest = github.get_latest()
-        await ctx.send(
-            f"I am currently running Reaction Light v{util.__version__}. The latest"
-            f" available version is v{latest}."
-        )
+    if await util.isadmin(ctx.message.author, ctx.guild.id):
+        latest = await util.update_check.get_latest()
+        if latest:
+            await ctx.send(
+                f"I am currently running Reaction Light v{util.__version__}. The"
+                f" latest available version is v{latest}."
+            )
+
+        else:
+            await ctx.send(
+                f"I am currently running Reaction Light v{util.__version__}. I could"
+                " not check for the latest available version."
+            )
 
     else:
         await ctx.send("You do not have an admin role.")
 
 
+@commands.is_owner()
+@bot.command(name="stats")
+async def print_stats(ctx):
+    index = db.reaction_index
+    sessions = db.reactionrole_creation
+    events = util.reaction_stats["events"]
+    rest_calls = util.reaction_stats["rest_calls"]
+    uptime = max(1, time() - util.stats_since)
+    text = (
+        f"**Reaction-role index**\n- Managed messages: {len(index.messages)}\n"
+        f"- Hits: {index.hits}\n- Misses: {index.misses}\n"
+        f"**Reaction events**\n- Processed: {events}\n- REST calls: {rest_calls}"
+        f" ({rest_calls / events if events else 0:.2f} per event)\n"
+        f"- Role changes coalesced: {util.role_changes.submitted} into"
+        f" {util.role_changes.flushed} edits\n"
+        f"- Edits skipped: {util.reaction_stats['skipped']}\n"
+        f"- Ignored for deleted roles: {util.reaction_stats['invalid']}\n"
+        f"- Dropped by the gateway filter: {util.reaction_filter.dropped}\n"
+        f"**Messages**\n- Short-circuited: {util.message_stats['short_circuited']}\n"
+        f"- Routed to a creation wizard: {util.message_stats['routed']}\n"
+        f"**Creation processes**\n- Active: {len(sessions)}\n- Restored:"
+        f" {sessions.restored}\n- Evicted when idle: {sessions.evicted_idle}\n"
+        f"- Evicted when full: {sessions.evicted_capacity}\n"
+        "**Database cleaning**\n"
+        + (
+            f"- {util.cleanup_stats['verified']} messages verified with"
+            f" {util.cleanup_stats['rest_calls']} REST calls,"
+            f" {util.cleanup_stats['deleted']} deleted\n- Last slice:"
+            f" {util.cleanup_stats['slice_size']} messages in"
+            f" {util.cleanup_stats['seconds']}s\n"
+            if util.cleanup_stats
+            else "- Not run yet\n"
+        )
+        + "**Reaction-role validation**\n"
+        + (
+            f"- {util.mapping_stats['checked']} combinations checked:"
+            f" {util.mapping_stats['roles']} with deleted roles,"
+            f" {util.mapping_stats['emojis']} with unusable emojis,"
+            f" {util.mapping_stats['unassignable']} with unassignable roles,"
+            f" {util.mapping_stats['pruned']} removed\n"
+            if util.mapping_stats
+            else "- Not run yet\n"
+        )
+        + f"**Presence**\n- Updates sent: {util.presence.updates}\n"
+        f"- Skipped as unchanged: {util.presence.redundant}\n"
+        f"- Deferred for the gateway budget: {util.presence.deferred}\n"
+        + "**Reconciliation**\n"
+        + (
+            f"- {'Running' if util.reconcile_stats['running'] else 'Finished'}:"
+            f" {util.reconcile_stats['messages']} of about"
+            f" {util.reconcile_stats['total']} messages,"
+            f" {util.reconcile_stats['added']} roles added,"
+            f" {util.reconcile_stats['removed']} removed,"
+            f" {util.reconcile_stats['failed']} failed,"
+            f" {util.reconcile_stats['rest_calls']} REST calls\n"
+            if util.reconcile_stats
+            else "- Not run yet\n"
+        )
+        + "**Shards**\n"
+        + "".join(
+            f"- Shard {shard_id}: {latency * 1000:.0f} ms latency,"
+            f" {util.shard_events.get(shard_id, 0)} reaction events"
+            f" ({util.shard_events.get(shard_id, 0) / uptime:.2f}/s)\n"
+            for shard_id, latency in util.latencies()
+        )
+        + (
+            f"**Cluster**\n- Process {util.cluster_id} with shards"
+            f" {', '.join(str(shard_id) for shard_id in util.cluster_shard_ids)}\n"
+            f"- Cleaning the database: {'yes' if util.is_leader else 'no'}\n"
+            if util.cluster_id is not None
+            else ""
+        )
+        + f"**Notifications**\n- Received: {util.notifier.received}\n"
+        f"- Merged into digests: {util.notifier.deduplicated}\n"
+        f"- Messages sent: {util.notifier.delivered}\n"
+        f"- Dropped when over budget: {util.notifier.dropped}\n"
+        + "**Reaction pipeline**\n"
+        + "\n".join(
+            f"- {stage.name}: {stage.qsize()} queued, {stage.stats.processed}"
+            f" processed, {stage.stats.dropped} dropped"
+            + (
+                f" in {len(stage.stats.guild_dropped)} guilds"
+                if stage.stats.guild_dropped
+                else ""
+            )
+            + ", avg"
+            f" {stage.stats.average_latency * 1000:.1f} ms, max"
+            f" {stage.stats.max_latency * 1000:.1f} ms"
+            for stage in util.reaction_pipeline
+        )
+    )
+    # One line per shard can take the stats over the message length limit
+    for message in util.split_message(text):
+        await ctx.send(message)
+
+
 @commands.is_owner()
 @bot.command(name="kill")
 async def kill(ctx):
     await ctx.send("Shutting down...")
+    await util.save_sessions()
     shutdown()  # sys.exit()
 
 
@@ -655,6 +793,7 @@ async def kill(ctx):
 @bot.command(name="restart")
 async def restart_cmd(ctx):
     if platform != "win32":
+        await util.save_sessions()
         util.restart()
         await ctx.send("Restarting...")
         shutdown()  # sys.exit()
@@ -674,6 +813,7 @@ async def update(ctx):
         cmd = os.popen("git pull")
         cmd.close()
         await ctx.send("Creating database backup...")
+        await util.save_sessions()
         copy(util.db_file, f"{db_file}.bak")
         util.restart()
         await ctx.send("Restarting...")
@@ -23,32 +23,56 @@ SOFTWARE.
 """
 
 
+import asyncio
 import datetime
+from time import perf_counter, monotonic
 
 import discord
 from discord.ext import tasks
 
-from core import database, github
+from core import database
 
 import bot_util as util
 
 bot = util.get_bot()
 
+# Seconds a cleanup REST call may take before the slice size is reduced
+CLEANUP_TARGET_LATENCY = 1.0
+MIN_CLEANUP_SLICE = 10
+# Messages reconciled before waiting for their role changes and saving the progress
+RECONCILE_BATCH_SIZE = 10
+
 activities = util.activities
-db = database.Database(util.db_file)
+db = util.db
 
 
 @tasks.loop(seconds=30)
 async def maintain_presence():
     # Loops through the activities specified in activities.csv
-    activity = activities.get()
-    await bot.change_presence(activity=discord.Game(name=activity))
+    activity = util.presence.tick()
+    now = monotonic()
+    for shard_id, ws in util.gateway_connections():
+        if util.presence.should_send(shard_id, now, util.gateway_headroom(ws)):
+            if shard_id is None:
+                await bot.change_presence(activity=discord.Game(name=activity))
+
+            else:
+                await bot.change_presence(
+                    activity=discord.Game(name=activity), shard_id=shard_id
+                )
+
+
+@tasks.loop(minutes=1)
+async def expire_sessions():
+    # Aborts abandoned creation processes and saves the remaining ones
+    db.reactionrole_creation.expire()
+    await util.save_sessions()
 
 
 @tasks.loop(hours=24)
 async def updates():
     # Sends a reminder once a day if there are updates available
-    new_version = github.check_for_updates(util.__version__)
+    new_version = await util.update_check.check_for_updates(util.__version__)
     if new_version:
         await util.system_notification(
             None,
@@ -59,13 +83,91 @@ async def updates():
         )
 
 
-@tasks.loop(hours=24)
+async def verify_channel(channel_id, rows, cached_messages, stats):
+    # Deletes the rows of the reaction-role messages of a channel that don't exist anymore
+    guild_id = rows[0][3]
+    channel = bot.get_channel(channel_id)
+    if not channel:
+        try:
+            stats["rest_calls"] += 1
+            channel = await bot.fetch_channel(channel_id)
+
+        except discord.NotFound as e:
+            # If unknown channel
+            if e.code == 10003:
+                for message in rows:
+                    await delete_message(message, f"channel {channel_id}", stats)
+
+            return
+
+        except discord.Forbidden:
+            # If we can't fetch the channel due to the bot not being in the guild or permissions we usually cant mention it or get the guilds id using the channels object
+            await util.system_notification(
+                guild_id,
+                "I do not have access to a channel with reaction-role messages I have"
+                " created anymore. I cannot manage the roles of users reacting to them."
+                f"\n\nIDs: {', '.join(str(message[0]) for message in rows)} in channel"
+                f" {channel_id}",
+            )
+            return
+
+    for message in rows:
+        if message[0] in cached_messages:
+            stats["verified"] += 1
+            continue
+
+        try:
+            stats["rest_calls"] += 1
+            await channel.fetch_message(message[0])
+            stats["verified"] += 1
+
+        except discord.NotFound as e:
+            # If unknown message
+            if e.code == 10008:
+                await delete_message(message, channel.mention, stats)
+
+        except discord.Forbidden:
+            await util.system_notification(
+                guild_id,
+                "I do not have access to a message I have created anymore. "
+                "I cannot manage the roles of users reacting to it."
+                f"\n\nID: {message[0]} in {channel.mention}",
+            )
+
+
+async def delete_message(message, location, stats):
+    delete = await db.delete(message[0])
+
+    if isinstance(delete, Exception):
+        await util.system_notification(
+            message[3],
+            "Database error when deleting messages during database"
+            f" cleaning:\n```\n{delete}\n```",
+        )
+        return
+
+    stats["deleted"] += 1
+    await util.system_notification(
+        message[3],
+        "I deleted the database entries of a message that was removed."
+        f"\n\nID: {message[0]} in {location}",
+    )
+
+
+@tasks.loop(minutes=5)
 async def cleandb():
     # Cleans the database by deleting rows of reaction role messages that don't exist anymore
-    messages = db.fetch_all_messages()
-    guilds = db.fetch_all_guilds()
-    # Get the cleanup queued guilds
-    cleanup_guild_ids = db.fetch_cleanup_guilds(guild_ids_only=True)
+    # Every run verifies the slice of messages that were not verified for the longest time
+    if not util.is_leader:
+        # Another process of the cluster cleans the database
+        return
+
+    slice_size = await db.get_state("cleanup_slice_size", util.cleanup_slice_size)
+    if isinstance(slice_size, Exception):
+        slice_size = util.cleanup_slice_size
+
+    slice_size = min(slice_size, util.cleanup_max_slice_size)
+    messages = await db.fetch_unverified_messages(slice_size)
 
     if isinstance(messages, Exception):
         await util.system_notification(
@@ -75,63 +177,103 @@ async def cleandb():
         )
         return
 
+    if not messages:
+        return
+
+    start = perf_counter()
+    stats = {"verified": 0, "deleted": 0, "rest_calls": 0}
+    # Verifies each channel once, a few channels at the same time
+    channels = {}
     for message in messages:
-        try:
-            channel_id = message[1]
-            channel = await bot.fetch_channel(channel_id)
+        channels.setdefault(message[1], []).append(message)
 
-            await channel.fetch_message(message[0])
+    cached_messages = {message.id for message in bot.cached_messages}
+    pending = iter(channels.items())
 
-        except discord.NotFound as e:
-            # If unknown channel or unknown message
-            if e.code == 10003 or e.code == 10008:
-                delete = db.delete(message[0], message[3])
-
-                if isinstance(delete, Exception):
-                    await util.system_notification(
-                        channel.guild.id,
-                        "Database error when deleting messages during database"
-                        f" cleaning:\n```\n{delete}\n```",
-                    )
-                    return
-
-                await util.system_notification(
-                    channel.guild.id,
-                    "I deleted the database entries of a message that was removed."
-                    f"\n\nID: {message} in {channel.mention}",
-                )
+    async def worker():
+        for channel_id, rows in pending:
+            await verify_channel(channel_id, rows, cached_messages, stats)
+
+    await asyncio.gather(*(worker() for _ in range(util.cleanup_concurrency)))
+    # Checked rows go to the back of the queue even if they could not be accessed
+    now = round(datetime.datetime.utcnow().timestamp())
+    await db.mark_verified([message[0] for message in messages], now)
+    elapsed = perf_counter() - start
+
+    # Discord.py waits out rate limits internally, so slow REST calls mean that
+    # there is little headroom left and the next slice has to be smaller
+    if stats["rest_calls"]:
+        latency = elapsed * util.cleanup_concurrency / stats["rest_calls"]
+        if latency > CLEANUP_TARGET_LATENCY:
+            slice_size = max(MIN_CLEANUP_SLICE, slice_size // 2)
+
+        else:
+            slice_size = min(util.cleanup_max_slice_size, slice_size + slice_size // 4 + 1)
+
+    await db.set_state("cleanup_slice_size", slice_size)
+
+    # Spreads a full pass over all messages across the day
+    total = await db.count_messages()
+    if not isinstance(total, Exception):
+        slices = max(1, -(-total // slice_size))
+        cleandb.change_interval(seconds=max(60, 86400 / slices))
+
+    stats["seconds"] = round(elapsed, 1)
+    stats["slice_size"] = slice_size
+    for key in ("verified", "deleted", "rest_calls"):
+        util.cleanup_stats[key] = util.cleanup_stats.get(key, 0) + stats[key]
+
+    util.cleanup_stats["seconds"] = stats["seconds"]
+    util.cleanup_stats["slice_size"] = slice_size
 
-        except discord.Forbidden:
-            # If we can't fetch the channel due to the bot not being in the guild or permissions we usually cant mention it or get the guilds id using the channels object
-            await util.system_notification(
-                message[3],
-                "I do not have access to a message I have created anymore. "
-                "I cannot manage the roles of users reacting to it."
-                f"\n\nID: {message[0]} in channel {message[1]}",
-            )
 
-    if isinstance(guilds, Exception):
+@cleandb.before_loop
+async def before_cleandb():
+    # Avoids a burst of REST calls right after every restart
+    await bot.wait_until_ready()
+    await asyncio.sleep(cleandb.seconds)
+
+
+@tasks.loop(hours=1)
+async def cleanguilds():
+    # Queues the stored guilds the bot is not in anymore, using the gateway guild cache
+    guilds = await db.fetch_all_guilds()
+    cleanup_guild_ids = await db.fetch_cleanup_guilds(guild_ids_only=True)
+
+    if isinstance(guilds, Exception) or isinstance(cleanup_guild_ids, Exception):
+        error = guilds if isinstance(guilds, Exception) else cleanup_guild_ids
         await util.system_notification(
             None,
             "Database error when fetching guilds during database"
-            f" cleaning:\n```\n{guilds}\n```",
+            f" cleaning:\n```\n{error}\n```",
         )
         return
 
+    now = round(datetime.datetime.utcnow().timestamp())
     for guild_id in guilds:
-        try:
-            await bot.fetch_guild(guild_id)
-            if guild_id in cleanup_guild_ids:
-                db.remove_cleanup_guild(guild_id)
+        if not util.owns_guild(guild_id):
+            # The guild belongs to another process of the cluster
+            continue
 
-        except discord.Forbidden:
-            # If unknown guild
+        if bot.get_guild(guild_id):
             if guild_id in cleanup_guild_ids:
-                continue
-            else:
-                db.add_cleanup_guild(guild_id, round(datetime.datetime.utcnow().timestamp()))
+                await db.remove_cleanup_guild(guild_id)
 
-    cleanup_guilds = db.fetch_cleanup_guilds()
+        elif guild_id not in cleanup_guild_ids:
+            await db.add_cleanup_guild(guild_id, now)
+
+
+@cleanguilds.before_loop
+async def before_cleanguilds():
+    # The guild cache is only complete once the bot is ready
+    await bot.wait_until_ready()
+
+
+@tasks.loop(hours=1)
+async def check_cleanup_queued_guilds():
+    # Purges the database entries of guilds that have been gone for more than 24 hours
+    now = round(datetime.datetime.utcnow().timestamp())
+    cleanup_guilds = await db.fetch_cleanup_guilds(queued_before=now - 86400)
 
     if isinstance(cleanup_guilds, Exception):
         await util.system_notification(
@@ -141,42 +283,280 @@ async def cleandb():
         )
         return
 
-    current_timestamp = round(datetime.datetime.utcnow().timestamp())
-    for guild in cleanup_guilds:
-        if int(guild[1]) - current_timestamp <= -86400:
-            # The guild has been invalid / unreachable for more than 24 hrs, try one more fetch then give up and purge the guilds database entries
-            try:
-                await bot.fetch_guild(guild[0])
-                db.remove_cleanup_guild(guild[0])
+    for guild_id in cleanup_guilds:
+        if not util.owns_guild(guild_id):
+            continue
+
+        if bot.get_guild(guild_id):
+            # The bot joined the guild again
+            await db.remove_cleanup_guild(guild_id)
+            continue
+
+        # Also deletes the cleanup queue entry of the guild
+        delete = await db.remove_guild(guild_id)
+        if isinstance(delete, Exception):
+            await util.system_notification(
+                None,
+                "Database error when deleting a guilds datebase entries during"
+                f" database cleaning:\n```\n{delete}\n```",
+            )
+            return
+
+
+@check_cleanup_queued_guilds.before_loop
+async def before_check_cleanup_queued_guilds():
+    await bot.wait_until_ready()
+
+
+@tasks.loop(hours=1)
+async def validate_mappings():
+    # Checks the stored roles and emojis against the gateway cache in a single pass
+    mappings = await db.fetch_all_mappings()
+    if isinstance(mappings, Exception):
+        await util.system_notification(
+            None,
+            "Database error when fetching reaction-role combinations during"
+            f" validation:\n```\n{mappings}\n```",
+        )
+        return
+
+    # A process of a cluster only sees the emojis of its own guilds and cannot tell
+    # which guild an emoji it does not know belongs to, so it does not judge them
+    emoji_ids = {emoji.id for emoji in bot.emojis}
+    check_emojis = util.cluster_id is None
+    guilds = {}
+    for guild_id, message_id, reactionrole_id, reaction, role_id in mappings:
+        guilds.setdefault(guild_id, []).append(
+            (message_id, reactionrole_id, reaction, role_id)
+        )
+
+    broken = []
+    invalid_roles = set()
+    stats = {"checked": len(mappings), "roles": 0, "emojis": 0, "unassignable": 0}
+    reports = {}
+    for guild_id, rows in guilds.items():
+        guild = bot.get_guild(guild_id)
+        if not guild or guild.unavailable:
+            # Guilds the bot left are handled by the guild cleaning
+            continue
+
+        roles = {role.id: role for role in guild.roles}
+        top_role = guild.me.top_role if guild.me else None
+        for message_id, reactionrole_id, reaction, role_id in rows:
+            role = roles.get(role_id)
+            emoji_id = database.custom_emoji_id(reaction)
+            if role is None:
+                # Reactions giving a deleted role can never succeed, wherever they are
+                stats["roles"] += 1
+                invalid_roles.add(role_id)
+                problem = f"{reaction} gives a role that was deleted ({role_id})"
+
+            elif check_emojis and emoji_id is not None and emoji_id not in emoji_ids:
+                stats["emojis"] += 1
+                problem = f"{reaction} is an emoji I cannot use anymore"
+
+            elif role.managed or role.is_default() or (top_role and role >= top_role):
+                # Only reported, the role works again as soon as the hierarchy is fixed
+                stats["unassignable"] += 1
+                reports.setdefault(guild_id, []).append(
+                    f"{reaction} gives {role.mention}, which I cannot assign"
+                    f" (message {message_id})"
+                )
                 continue
 
-            except discord.Forbidden:
-                delete = db.remove_guild(guild[0])
-                delete2 = db.remove_cleanup_guild(guild[0])
-                if isinstance(delete, Exception):
-                    await util.system_notification(
-                        None,
-                        "Database error when deleting a guilds datebase entries during"
-                        f" database cleaning:\n```\n{delete}\n```",
-                    )
-                    return
-
-                elif isinstance(delete2, Exception):
-                    await util.system_notification(
-                        None,
-                        "Database error when deleting a guilds datebase entries during"
-                        f" database cleaning:\n```\n{delete2}\n```",
-                    )
-                    return
-
-
-@tasks.loop(hours=6)
-async def check_cleanup_queued_guilds():
-    cleanup_guild_ids = db.fetch_cleanup_guilds(guild_ids_only=True)
-    for guild_id in cleanup_guild_ids:
-        try:
-            await bot.fetch_guild(guild_id)
-            db.remove_cleanup_guild(guild_id)
+            else:
+                continue
 
-        except discord.Forbidden:
-            continue
\ No newline at end of file
+            broken.append((message_id, reactionrole_id, reaction))
+            reports.setdefault(guild_id, []).append(f"{problem} (message {message_id})")
+
+    stats["pruned"] = 0
+    if broken and util.prune_invalid_mappings:
+        remove = await db.remove_mappings(broken)
+        if isinstance(remove, Exception):
+            await util.system_notification(
+                None,
+                "Database error when removing invalid reaction-role combinations"
+                f" during validation:\n```\n{remove}\n```",
+            )
+
+        else:
+            stats["pruned"] = len(broken)
+
+    # Guilds are only notified about problems that were not reported before
+    reported = util.mapping_stats.get("reported", set())
+    for guild_id, problems in reports.items():
+        new_problems = [problem for problem in problems if problem not in reported]
+        if new_problems:
+            action = "removed" if stats["pruned"] else "found"
+            await util.system_notification(
+                guild_id,
+                f"I {action} {len(new_problems)} reaction-role combinations that"
+                " cannot work anymore:\n- " + "\n- ".join(new_problems),
+            )
+
+    util.invalid_roles.clear()
+    util.invalid_roles.update(invalid_roles)
+    stats["reported"] = {problem for problems in reports.values() for problem in problems}
+    util.mapping_stats.clear()
+    util.mapping_stats.update(stats)
+
+
+@validate_mappings.before_loop
+async def before_validate_mappings():
+    await bot.wait_until_ready()
+
+
+async def reconcile_message(message_id, channel_id, guild_id, stats, shard_id=None):
+    # Finds the roles of the members whose reactions to a message changed unnoticed
+    # Returns the corrections as (guild_id, member_id, role_id, add) tuples
+    changes = []
+    combos = db.reaction_index.messages.get(message_id)
+    guild = bot.get_guild(guild_id) if guild_id else None
+    channel = bot.get_channel(channel_id)
+    if not combos or not guild or not channel:
+        return changes
+
+    if shard_id is not None and guild.shard_id != shard_id:
+        return changes
+
+    try:
+        stats["rest_calls"] += 1
+        message = await channel.fetch_message(message_id)
+
+    except (discord.NotFound, discord.Forbidden):
+        # Left to the database cleaning
+        return changes
+
+    reactions = {str(reaction.emoji): reaction for reaction in message.reactions}
+    for emoji, role_id in combos.items():
+        role = guild.get_role(role_id)
+        if not role or role_id in util.invalid_roles:
+            continue
+
+        reacted = set()
+        reaction = reactions.get(emoji)
+        if reaction:
+            # Users are paged by 100
+            stats["rest_calls"] += -(-reaction.count // 100)
+            async for user in reaction.users(limit=None):
+                reacted.add(user.id)
+
+        holders = {member.id for member in role.members}
+        for member_id in reacted - holders:
+            if member_id != bot.user.id and guild.get_member(member_id):
+                changes.append((guild_id, member_id, role_id, True))
+
+        if util.reconcile_remove_roles:
+            for member_id in holders - reacted:
+                changes.append((guild_id, member_id, role_id, False))
+
+    return changes
+
+
+async def apply_corrections(changes, stats):
+    # Submits the corrections in chunks that fit in the apply queue of a guild and
+    # waits for each chunk, only the role changes that were made are counted
+    for start in range(0, len(changes), util.guild_queue_size):
+        chunk = changes[start : start + util.guild_queue_size]
+        results = await asyncio.gather(
+            *(util.role_changes.submit(*change) for change in chunk)
+        )
+        for change, applied in zip(chunk, results):
+            if applied:
+                stats["added" if change[3] else "removed"] += 1
+
+            else:
+                stats["failed"] += 1
+
+
+@tasks.loop(count=1)
+async def reconcile(shard_id=None):
+    # Goes through every reaction-role message, resuming where an interrupted run stopped
+    # With a shard_id only the guilds of that shard are reconciled
+    checkpoint_key = "reconcile_checkpoint"
+    if util.cluster_id is not None:
+        # Every process of a cluster goes through the messages of its own guilds
+        checkpoint_key += f"_cluster_{util.cluster_id}"
+
+    if shard_id is not None:
+        checkpoint_key += f"_{shard_id}"
+    checkpoint = await db.get_state(checkpoint_key, 0)
+    if isinstance(checkpoint, Exception):
+        checkpoint = 0
+
+    total = await db.count_messages()
+    stats = util.reconcile_stats
+    stats.clear()
+    stats.update(
+        {
+            "running": True,
+            "shard_id": shard_id,
+            "resumed": checkpoint > 0,
+            "messages": 0,
+            "total": total if not isinstance(total, Exception) else 0,
+            "added": 0,
+            "removed": 0,
+            "failed": 0,
+            "rest_calls": 0,
+        }
+    )
+    start = perf_counter()
+    while True:
+        messages = await db.fetch_messages_after(checkpoint, RECONCILE_BATCH_SIZE)
+        if isinstance(messages, Exception):
+            await util.system_notification(
+                None,
+                "Database error when fetching messages during"
+                f" reconciliation:\n```\n{messages}\n```",
+            )
+            break
+
+        if not messages:
+            # The next run starts from the beginning
+            await db.set_state(checkpoint_key, 0)
+            break
+
+        changes = []
+        for message_id, channel_id, guild_id in messages:
+            changes += await reconcile_message(
+                message_id, channel_id, guild_id, stats, shard_id
+            )
+            stats["messages"] += 1
+
+        # Role changes are applied batch by batch so the checkpoint is only
+        # moved past messages whose corrections ran
+        await apply_corrections(changes, stats)
+        checkpoint = messages[-1][0]
+        await db.set_state(checkpoint_key, checkpoint)
+
+    stats["running"] = False
+    stats["seconds"] = round(perf_counter() - start, 1)
+    if stats["added"] or stats["removed"]:
+        await util.system_notification(
+            None,
+            f"I caught up on reactions changed while I was offline: {stats['added']}"
+            f" roles added and {stats['removed']} roles removed in"
+            f" {stats['messages']} reaction-role messages.",
+        )
+
+
+@reconcile.before_loop
+async def before_reconcile():
+    await bot.wait_until_ready()
+
+
+@tasks.loop(seconds=1)
+async def sync_caches():
+    # Picks up reaction-role messages and settings changed by other processes of the cluster
+    refreshed = await db.refresh_caches()
+    if isinstance(refreshed, Exception):
+        print(f"Database error when refreshing the caches:\n{refreshed}")
+
+
+@tasks.loop(seconds=20)
+async def elect_leader():
+    # Renews the lease well before it expires, or takes it over from a stopped process
+    now = round(datetime.datetime.utcnow().timestamp())
+    leader = await db.run_write(util.leader_lease.acquire, now)
+    util.is_leader = leader is True
@@ -24,15 +24,36 @@ SOFTWARE.
 
 
 import os
+import asyncio
+from time import time
 import configparser
 from sys import platform
 
 import discord
 from discord.ext import commands
 
-from core import database, migration, activity, schema
+from core import (
+    database,
+    migration,
+    activity,
+    schema,
+    roles,
+    pipeline,
+    gateway,
+    notifications,
+    github,
+    cluster,
+)
 
 directory = os.path.dirname(os.path.realpath(__file__))
+db_file = f"{directory}/files/reactionlight.db"
+
+# SQLite tuning profile, it has to be set before the database is first opened
+db_config = configparser.ConfigParser()
+db_config.read(f"{directory}/config.ini")
+database.configure(
+    db_file, dict(db_config["database"]) if db_config.has_section("database") else {}
+)
 
 migrated = migration.migrate()
 config_migrated = migration.migrateconfig()
@@ -53,11 +74,94 @@ system_channel = (
     if config.get("server", "system_channel")
     else None
 )
+# Seconds to wait for more reactions of a member before editing their roles
+role_update_window = config.getfloat("server", "role_update_window", fallback=0.5)
+# Bounds of the reaction processing pipeline
+reaction_queue_size = config.getint("server", "reaction_queue_size", fallback=1000)
+guild_queue_size = config.getint("server", "guild_queue_size", fallback=100)
+role_workers = config.getint("server", "role_workers", fallback=4)
+# Drop reactions to unmanaged messages before discord.py parses them
+gateway_reaction_filter = config.getboolean(
+    "server", "gateway_reaction_filter", fallback=False
+)
 
 activities_file = f"{directory}/files/activities.csv"
 activities = activity.Activities(activities_file)
-db_file = f"{directory}/files/reactionlight.db"
-db = database.Database(db_file)
+# Presence updates are only sent when the activity changes and the gateway has headroom
+presence = activity.PresenceRotation(activities)
+# Channels verified at the same time when cleaning the database
+cleanup_concurrency = config.getint("server", "cleanup_concurrency", fallback=5)
+# Messages verified per cleanup run, adapted to the rate limit headroom
+cleanup_slice_size = config.getint("server", "cleanup_slice_size", fallback=100)
+cleanup_max_slice_size = config.getint("server", "cleanup_max_slice_size", fallback=1000)
+# Seconds identical notifications are collected for before a digest is sent
+# and messages sent per minute at most to the same channel
+notification_window = config.getfloat("server", "notification_window", fallback=10)
+notification_budget = max(1, config.getint("server", "notification_budget", fallback=5))
+# Number of gateway shards, empty for a single connection or "auto" to let Discord decide
+shard_count = config.get("server", "shard_count", fallback="").strip().lower()
+# Set by cluster.py for each of its processes, every process owns a range of shards
+cluster_id = os.environ.get("RL_CLUSTER_ID")
+cluster_shard_ids = (
+    [int(shard_id) for shard_id in os.environ["RL_SHARD_IDS"].split(",")]
+    if os.environ.get("RL_SHARD_IDS")
+    else None
+)
+cluster_shard_count = int(os.environ.get("RL_SHARD_COUNT", 0)) or None
+# Where the latest version is read from, and whether the bot looks for updates at all
+update_check = github.UpdateChecker(
+    url=config.get("server", "update_url", fallback=github.LATEST_VERSION_URL),
+    timeout=config.getfloat("server", "update_timeout", fallback=10),
+    offline=not config.getboolean("server", "update_check", fallback=True),
+)
+# Catch up on reactions added or removed while the bot was offline
+reconcile_on_ready = config.getboolean("server", "reconcile_on_ready", fallback=True)
+reconcile_remove_roles = config.getboolean(
+    "server", "reconcile_remove_roles", fallback=False
+)
+# Delete combinations with deleted roles or emojis instead of only reporting them
+prune_invalid_mappings = config.getboolean(
+    "server", "prune_invalid_mappings", fallback=False
+)
+# Creation processes idle for longer than session_ttl seconds are aborted
+session_ttl = config.getint("server", "session_ttl", fallback=900)
+max_sessions = config.getint("server", "max_sessions", fallback=1000)
+persist_sessions = config.getboolean("server", "persist_sessions", fallback=True)
+db = database.AsyncDatabase(
+    db_file,
+    session_ttl=session_ttl,
+    max_sessions=max_sessions,
+    persist_sessions=persist_sessions,
+    shard_ids=cluster_shard_ids,
+    shard_count=cluster_shard_count,
+)
+# Only the process holding the lease cleans the database
+leader_lease = (
+    cluster.Lease(
+        f"{folder}/cluster.db", "cleandb", f"{cluster_id}:{os.getpid()}", duration=60
+    )
+    if cluster_id is not None
+    else None
+)
+is_leader = leader_lease is None
+
+# Number of managed reaction events processed, the REST calls they needed
+# the role changes skipped because the member already had the desired roles
+# and the reactions ignored because their role cannot be assigned
+reaction_stats = {"events": 0, "rest_calls": 0, "skipped": 0, "invalid": 0}
+# Messages ignored with a single lookup and messages routed to a creation wizard
+message_stats = {"short_circuited": 0, "routed": 0}
+# Totals of the database cleaning runs and details of the last one
+cleanup_stats = {}
+# Counts of the last validation of the stored reaction-role combinations
+mapping_stats = {}
+# Reaction events received by every shard since stats_since
+shard_events = {}
+stats_since = time()
+# Progress of the current or last reconciliation
+reconcile_stats = {}
+# Deleted roles still used by combinations, reactions to them need no REST calls
+invalid_roles = set()
 
 intents = discord.Intents.default()
 intents.members = True
@@ -80,7 +184,25 @@ class BotSingleton:
             raise Exception("This class is a singleton! Only one refernce can exist.")
         else:
             BotSingleton.__instance = self
-            BotSingleton.__botInfo = commands.Bot(command_prefix=prefix, intents=intents)
+            if cluster_shard_ids:
+                BotSingleton.__botInfo = commands.AutoShardedBot(
+                    command_prefix=prefix,
+                    intents=intents,
+                    shard_ids=cluster_shard_ids,
+                    shard_count=cluster_shard_count,
+                )
+
+            elif shard_count:
+                BotSingleton.__botInfo = commands.AutoShardedBot(
+                    command_prefix=prefix,
+                    intents=intents,
+                    shard_count=None if shard_count == "auto" else int(shard_count),
+                )
+
+            else:
+                BotSingleton.__botInfo = commands.Bot(
+                    command_prefix=prefix, intents=intents
+                )
 
     def get_bot_info(self):
         return BotSingleton.__botInfo
@@ -91,25 +213,240 @@ def get_bot():
 
 
 bot = get_bot()
+reaction_filter = gateway.ReactionGatewayFilter(db.reaction_index.__contains__)
+if gateway_reaction_filter:
+    # Reaction counts of cached unmanaged messages will not be updated anymore
+    reaction_filter.install(bot._connection.parsers)
 
 
-def isadmin(member, guild_id):
-    # Checks if command author has an admin role that was added with rl!admin
-    admins = db.get_admins(guild_id)
+async def apply_role_changes(guild_id, member_id, changes):
+    # Applies the coalesced role changes of a member in a single edit
+    # Returns False if the changes could not be made
+    guild = bot.get_guild(guild_id)
+    member = guild.get_member(member_id) if guild else None
+    try:
+        if not member:
+            # The member is not cached, roles can only be changed one by one by ID
+            for role_id, add in changes.items():
+                reaction_stats["rest_calls"] += 1
+                if add:
+                    await bot.http.add_role(guild_id, member_id, role_id)
+
+                else:
+                    await bot.http.remove_role(guild_id, member_id, role_id)
+
+            return True
+
+        current = {role.id for role in member.roles if not role.is_default()}
+        desired = set(current)
+        for role_id, add in changes.items():
+            if guild.get_role(role_id) is None:
+                continue
+
+            if add:
+                desired.add(role_id)
+
+            else:
+                desired.discard(role_id)
+
+        if desired == current:
+            reaction_stats["skipped"] += 1
+            return True
+
+        reaction_stats["rest_calls"] += 1
+        added = desired - current
+        removed = current - desired
+        if len(added) + len(removed) == 1:
+            # A single change does not need to overwrite the whole role list
+            if added:
+                await member.add_roles(guild.get_role(added.pop()))
 
-    if isinstance(admins, Exception):
-        print(f"Error when checking if the member is an admin:\n{admins}")
+            else:
+                await member.remove_roles(guild.get_role(removed.pop()))
+
+        else:
+            await member.edit(roles=[guild.get_role(role_id) for role_id in desired])
+
+        return True
+
+    except discord.Forbidden:
+        notify_stage.put_nowait(
+            (
+                guild_id,
+                "Someone tried to change their roles but I do not have permissions"
+                " to do it. Ensure that I have a role that is hierarchically higher"
+                " than the roles I have to assign or remove, and that I have the"
+                " `Manage Roles` permission.",
+            )
+        )
         return False
 
+    except discord.NotFound:
+        # The member left the guild before the changes were applied
+        return False
+
+
+async def remove_unmapped_reaction(payload):
+    # Removes reactions added to the reaction-role message that are not connected to any role
+    channel = bot.get_channel(payload.channel_id)
+    if not channel:
+        reaction_stats["rest_calls"] += 1
+        channel = await bot.fetch_channel(payload.channel_id)
+
+    msg = channel.get_partial_message(payload.message_id)
+    reaction_stats["rest_calls"] += 1
+    try:
+        await msg.remove_reaction(
+            payload.emoji, payload.member or discord.Object(payload.user_id)
+        )
+
+    except discord.Forbidden:
+        notify_stage.put_nowait(
+            (
+                payload.guild_id,
+                "I do not have permissions to remove reactions that are not connected"
+                f" to any role from reaction-role messages in {channel.mention}.",
+            )
+        )
+
+    except discord.NotFound:
+        pass
+
+
+async def queue_role_changes(guild_id, member_id, changes):
+    # Runs the coalesced changes in the apply stage and returns if they were applied
+    # Every edit runs in its own coalescer task, waiting for room in a full guild
+    # queue slows down that guild only and never loses a role change
+    done = asyncio.get_event_loop().create_future()
+    await apply_stage.put(
+        (guild_id, apply_role_changes, (guild_id, member_id, changes), done)
+    )
+    return await done
+
+
+role_changes = roles.RoleChangeCoalescer(role_update_window, queue_role_changes)
+
+
+async def resolve_reaction(item):
+    # Stage 1: keeps only reactions to reaction-role messages managed by the bot
+    payload, added = item
+    if payload.guild_id:
+        shard_id = shard_of(payload.guild_id)
+        shard_events[shard_id] = shard_events.get(shard_id, 0) + 1
+
+    reactions = db.get_cached_reactions(payload.message_id)
+    if reactions is not None:
+        await decide_stage.put((payload, added, reactions))
+
+
+async def decide_reaction(item):
+    # Stage 2: turns a reaction into a role change or a reaction removal
+    payload, added, reactions = item
+    reaction_stats["events"] += 1
+    reaction = str(payload.emoji)
+    if reaction not in reactions:
+        if added:
+            # Removing the reaction is best effort, a busy guild must not hold up
+            # the reactions of every other guild
+            apply_stage.put_nowait(
+                (payload.guild_id, remove_unmapped_reaction, (payload,), None)
+            )
+
+    elif reactions[reaction] in invalid_roles:
+        reaction_stats["invalid"] += 1
+
+    elif payload.user_id != bot.user.id:
+        role_changes.submit(payload.guild_id, payload.user_id, reactions[reaction], added)
+
+
+async def apply_reaction(item):
+    # Stage 3: talks to the Discord API, one job per guild at a time
+    guild_id, job, args, done = item
+    result = False
     try:
-        member_roles = [role.id for role in member.roles]
-        return [admin_role for admin_role in admins if admin_role in member_roles]
+        result = await job(*args)
+
+    finally:
+        if done is not None and not done.done():
+            done.set_result(result)
+
+
+async def notify_reaction(item):
+    # Stage 4: reports errors found while applying changes
+    guild_id, text = item
+    await system_notification(guild_id, text)
+
+
+resolve_stage = pipeline.Stage("resolve", resolve_reaction, reaction_queue_size)
+decide_stage = pipeline.Stage("decide", decide_reaction, reaction_queue_size)
+apply_stage = pipeline.Stage(
+    "apply", apply_reaction, guild_queue_size, workers=role_workers, guild_fair=True
+)
+notify_stage = pipeline.Stage("notify", notify_reaction, reaction_queue_size)
+reaction_pipeline = [resolve_stage, decide_stage, apply_stage, notify_stage]
+
+
+def start_reaction_pipeline():
+    for stage in reaction_pipeline:
+        stage.start()
+
+
+async def isadmin(member, guild_id):
+    # Checks if command author has an admin role that was added with rl!admin
+    admins = db.get_cached_admins(guild_id)
+    if not admins:
+        return False
+
+    try:
+        return admins & {role.id for role in member.roles}
 
     except AttributeError:
         # Error raised from 'fake' users, such as webhooks
         return False
 
 
+def gateway_connections():
+    # (shard_id, websocket) of every gateway connection, shard_id is None without sharding
+    if isinstance(bot, commands.AutoShardedBot):
+        return [
+            (shard_id, getattr(getattr(shard, "_parent", None), "ws", None))
+            for shard_id, shard in bot.shards.items()
+        ]
+
+    return [(None, bot.ws)]
+
+
+def shard_of(guild_id):
+    # Shard that receives the events of a guild
+    return (guild_id >> 22) % (bot.shard_count or 1)
+
+
+def owns_guild(guild_id):
+    # Whether the events of a guild are received by this process
+    shard_ids = getattr(bot, "shard_ids", None)
+    return shard_ids is None or shard_of(guild_id) in shard_ids
+
+
+def latencies():
+    if isinstance(bot, commands.AutoShardedBot):
+        return bot.latencies
+
+    return [(0, bot.latency)]
+
+
+def gateway_headroom(ws):
+    # Gateway commands left in the current window of discord.py's limiter, None if unknown
+    limiter = getattr(ws, "_rate_limiter", None)
+    try:
+        if time() > limiter.window + limiter.per:
+            return limiter.max
+
+        return limiter.remaining
+
+    except AttributeError:
+        return None
+
+
 async def getchannel(id):
     channel = bot.get_channel(id)
 
@@ -146,88 +483,159 @@ def restart():
 
 
 async def database_updates():
-    handler = schema.SchemaHandler(db_file)
-    if handler.version == 0:
-        handler.update()
-        messages = db.fetch_all_messages()
+    # In cluster mode cluster.py already updated the schema before starting the
+    # processes and left the guild IDs of old messages to the first process
+    handler = await db.run_write(schema.SchemaHandler, db_file)
+    version = handler.version
+    await db.run_write(handler.update)
+    if cluster_id == "0" and await db.get_state("guild_backfill", 0) == 1:
+        version = 0
+
+    if version == 0:
+        messages = await db.fetch_all_messages()
         for message in messages:
             channel_id = message[1]
             channel = await getchannel(channel_id)
-            db.add_guild(channel.id, channel.guild.id)
+            await db.add_guild(channel.id, channel.guild.id)
 
+        if cluster_id is not None:
+            await db.set_state("guild_backfill", 0)
 
-async def system_notification(guild_id, text):
-    # Send a message to the system channel (if set)
-    if guild_id:
-        server_channel = db.fetch_systemchannel(guild_id)
+    scans = await db.run_read(handler.check_query_plans)
+    for query, detail in scans:
+        print(f"Database query not using an index ({detail}):\n{query}")
 
-        if isinstance(server_channel, Exception):
-            await system_notification(
-                None,
-                "Database error when fetching guild system"
-                f" channels:\n```\n{server_channel}\n```\n\n{text}",
-            )
-            return
 
-        if server_channel:
-            try:
-                target_channel = await getchannel(server_channel[0][0])
-                await target_channel.send(text)
+def split_message(text, limit=2000):
+    # Splits a text into messages Discord accepts, at line breaks where possible
+    messages = []
+    current = ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                messages.append(current)
+                current = ""
 
-            except discord.Forbidden:
-                await system_notification(None, text)
+            messages.append(line[:limit])
+            line = line[limit:]
+
+        if current and len(current) + len(line) + 1 > limit:
+            messages.append(current)
+            current = line
 
         else:
-            await system_notification(None, text)
+            current = f"{current}\n{line}" if current else line
+
+    if current:
+        messages.append(current)
 
-    elif system_channel:
-        try:
-            target_channel = await getchannel(system_channel)
-            await target_channel.send(text)
+    return messages
 
-        except discord.NotFound:
+
+async def send_notification(channel_id, text):
+    # Sends a digest of the notification dispatcher
+    if channel_id is None:
+        print(text)
+        return
+
+    try:
+        target_channel = await getchannel(channel_id)
+        await target_channel.send(text)
+
+    except (discord.NotFound, discord.Forbidden) as e:
+        if channel_id != system_channel:
+            # Falls back to the main system channel
+            notifier.notify(system_channel, text)
+
+        elif isinstance(e, discord.NotFound):
             print("I cannot find the system channel.")
 
-        except discord.Forbidden:
+        else:
             print("I cannot send messages to the system channel.")
 
-    else:
-        print(text)
+    except discord.HTTPException as e:
+        print(f"I could not send a notification to {channel_id}: {e}")
+
+
+notifier = notifications.NotificationDispatcher(
+    notification_window, send_notification, budget=notification_budget
+)
+
+
+async def system_notification(guild_id, text):
+    # Queues a message for the system channel of the guild (if set) or the main one
+    # Identical messages are sent once per digest with their count
+    server_channel = db.get_cached_systemchannel(guild_id) if guild_id else None
+    notifier.notify(server_channel or system_channel, text)
+
+
+async def save_sessions():
+    # Stores the creation processes in progress so that a restart resumes them
+    sessions = db.reactionrole_creation
+    if persist_sessions and sessions.dirty:
+        saved = await db.persist_sessions(sessions.snapshot())
+        if isinstance(saved, Exception):
+            print(f"Database error when saving creation processes:\n{saved}")
+
+
+# Stored as the title of legacy messages that were not found so they are not fetched again
+missing_title = "*Message not found*"
+# Legacy messages fetched at the same time when listing the messages of a channel
+title_fetch_limit = 5
+
+
+def message_title(message):
+    # Text shown for a reaction-role message when listing the messages of a channel
+    title = message.embeds[0].title if message.embeds else message.content
+    return str(title)[:100] if title else ""
 
 
 async def formatted_channel_list(channel):
-    all_messages = db.fetch_messages(channel.id)
+    all_messages = await db.fetch_message_titles(channel.id)
     if isinstance(all_messages, Exception):
         await system_notification(
             channel.guild.id,
             f"Database error when fetching messages:\n```\n{all_messages}\n```",
         )
-        return
-
-    formatted_list = []
-    counter = 1
-    for msg_id in all_messages:
-        try:
-            old_msg = await channel.fetch_message(int(msg_id))
-
-        except discord.NotFound:
-            # Skipping reaction-role messages that might have been deleted without updating CSVs
-            continue
-
-        except discord.Forbidden:
+        return []
+
+    # Messages created before titles were stored are fetched once, a few at a time
+    legacy = [msg_id for msg_id, title in all_messages if title is None]
+    limit = asyncio.Semaphore(title_fetch_limit)
+
+    async def fetch(msg_id):
+        async with limit:
+            return await channel.fetch_message(msg_id)
+
+    fetched = await asyncio.gather(
+        *(fetch(msg_id) for msg_id in legacy), return_exceptions=True
+    )
+    titles = {}
+    for msg_id, old_msg in zip(legacy, fetched):
+        if isinstance(old_msg, discord.Forbidden):
             await system_notification(
                 channel.guild.id,
                 "I do not have permissions to edit a reaction-role message"
                 f" that I previously created.\n\nID: {msg_id} in"
                 f" {channel.mention}",
             )
-            continue
 
-        entry = (
-            f"`{counter}`"
-            f" {old_msg.embeds[0].title if old_msg.embeds else old_msg.content}"
-        )
-        formatted_list.append(entry)
-        counter += 1
+        elif isinstance(old_msg, discord.Message):
+            titles[msg_id] = message_title(old_msg)
+
+        elif isinstance(old_msg, discord.NotFound):
+            # Left to the database cleaning, the message keeps its number until then
+            titles[msg_id] = missing_title
+
+    if titles:
+        await db.set_titles([(title, msg_id) for msg_id, title in titles.items()])
+
+    formatted_list = []
+    for counter, (msg_id, title) in enumerate(all_messages, 1):
+        if title is None:
+            # Messages that could not be fetched this time keep their number
+            title = titles.get(msg_id, missing_title)
+
+        formatted_list.append(f"`{counter}` {title}")
 
     return formatted_list
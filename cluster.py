@@ -0,0 +1,126 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import os
+import sys
+import json
+import time
+import configparser
+import subprocess
+from urllib.request import Request, urlopen
+
+from core import database, migration, schema
+from core.cluster import shard_ranges
+
+
+directory = os.path.dirname(os.path.realpath(__file__))
+db_file = f"{directory}/files/reactionlight.db"
+config = configparser.ConfigParser()
+config.read(f"{directory}/config.ini")
+
+
+def update_database():
+    # Migrations run once before the processes start, they would otherwise all try
+    # to alter the same tables at the same time
+    database.configure(
+        db_file, dict(config["database"]) if config.has_section("database") else {}
+    )
+    migration.migrate()
+    migration.migrateconfig()
+    db = database.Database(db_file)
+    handler = schema.SchemaHandler(db_file)
+    if handler.version == 0:
+        # Guild IDs of old messages can only be looked up on Discord, the first
+        # process does it once it is connected
+        db.set_state("guild_backfill", 1)
+
+    handler.update()
+
+
+def recommended_shards(token):
+    # Number of shards Discord recommends for the bot
+    request = Request(
+        "https://discord.com/api/v8/gateway/bot",
+        headers={"Authorization": f"Bot {token}", "User-Agent": "Reaction Light"},
+    )
+    with urlopen(request, timeout=10) as response:
+        return json.load(response)["shards"]
+
+
+def start(cluster_id, shard_ids, shard_count):
+    # Every process runs bot.py for its own range of shards
+    env = dict(
+        os.environ,
+        RL_CLUSTER_ID=str(cluster_id),
+        RL_SHARD_IDS=",".join(str(shard_id) for shard_id in shard_ids),
+        RL_SHARD_COUNT=str(shard_count),
+    )
+    return subprocess.Popen([sys.executable, f"{directory}/bot.py"], env=env)
+
+
+def main():
+    update_database()
+    processes = config.getint("server", "cluster_processes", fallback=os.cpu_count())
+    shard_count = config.get("server", "shard_count", fallback="").strip().lower()
+    if not shard_count or shard_count == "auto":
+        shard_count = max(
+            processes, recommended_shards(config.get("server", "token"))
+        )
+
+    ranges = shard_ranges(int(shard_count), processes)
+    print(
+        f"Starting {len(ranges)} processes for {shard_count} shards: "
+        + ", ".join(f"{shard_ids[0]}-{shard_ids[-1]}" for shard_ids in ranges)
+    )
+    children = {
+        cluster_id: start(cluster_id, shard_ids, shard_count)
+        for cluster_id, shard_ids in enumerate(ranges)
+    }
+    try:
+        while children:
+            time.sleep(5)
+            for cluster_id, child in list(children.items()):
+                code = child.poll()
+                if code is None:
+                    continue
+
+                if code == 0:
+                    # Stopped with rl!kill, or replaced itself with rl!restart
+                    del children[cluster_id]
+
+                else:
+                    print(f"Process {cluster_id} exited with code {code}, restarting it.")
+                    children[cluster_id] = start(
+                        cluster_id, ranges[cluster_id], shard_count
+                    )
+
+    except KeyboardInterrupt:
+        for child in children.values():
+            child.terminate()
+
+
+if __name__ == "__main__":
+    main()
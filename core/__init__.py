@@ -4,3 +4,8 @@ from .migration import *
 from .database import *
 from .github import *
 from .schema import *
+from .roles import *
+from .pipeline import *
+from .gateway import *
+from .notifications import *
+from .cluster import *
@@ -24,9 +24,9 @@ SOFTWARE.
 
 
 import csv
-from os import path
+from os import path, replace
 from shutil import copy
-from itertools import cycle
+from collections import deque
 
 
 class Activities:
@@ -36,6 +36,7 @@ class Activities:
 
     def load(self):
         self.activity_list = []
+        self.index = 0
         if not path.isfile(self.file):
             # Create activities.csv from the sample if it does not already exist
             copy(
@@ -49,27 +50,100 @@ class Activities:
                 activity = row[0]
                 self.activity_list.append(activity)
 
-        self.loop = cycle(self.activity_list)
+    def save(self):
+        # Writes a temporary file first so a crash never leaves a truncated activities.csv
+        temporary = f"{self.file}.tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            w = csv.writer(f, delimiter=",", lineterminator="\n")
+            for row in self.activity_list:
+                w.writerow([row])
+
+        replace(temporary, self.file)
+
+    def peek(self):
+        # Returns the activity that is due next without moving on, None if there are none
+        if not self.activity_list:
+            return None
+
+        return self.activity_list[self.index % len(self.activity_list)]
+
+    def advance(self):
+        if self.activity_list:
+            self.index = (self.index + 1) % len(self.activity_list)
 
     def get(self):
-        return next(self.loop)
+        activity = self.peek()
+        self.advance()
+        return activity
 
     def add(self, activity):
-        with open(self.file, "a", encoding="utf-8") as f:
-            w = csv.writer(f, delimiter=",", lineterminator="\n")
-            w.writerow([activity])
-
-        self.load()
+        self.activity_list.append(activity)
+        self.save()
 
     def remove(self, activity):
         if activity not in self.activity_list:
             return False
 
         self.activity_list.remove(activity)
-        with open(self.file, "w", encoding="utf-8") as f:
-            w = csv.writer(f, delimiter=",", lineterminator="\n")
-            for row in self.activity_list:
-                w.writerow([row])
+        self.save()
+        return True
 
-        self.load()
+
+class PresenceRotation:
+    def __init__(self, activities, budget=5, period=60, reserve=10):
+        # At most budget presence updates are sent to a shard every period seconds,
+        # and none while fewer than reserve gateway commands are left for
+        # heartbeats and member requests
+        self.activities = activities
+        self.budget = budget
+        self.period = period
+        self.reserve = reserve
+        self.current = None
+        self.last = {}
+        self.sent = {}
+        # Shards the current activity was deferred for on the last tick
+        self.lagging = set()
+        self.updates = 0
+        self.redundant = 0
+        self.deferred = 0
+
+    def reset(self, shard_id=None):
+        # A new gateway session starts without any presence
+        if shard_id is None:
+            self.last.clear()
+
+        else:
+            self.last.pop(shard_id, None)
+
+    def tick(self):
+        # Moves on to the next activity once the current one reached every shard,
+        # an activity that was deferred is retried instead
+        if self.current is None or not self.lagging:
+            self.current = self.activities.get()
+
+        self.lagging = set()
+        return self.current
+
+    def should_send(self, shard_id, now, gateway_remaining=None):
+        # Tells whether the current activity has to be sent to the shard now
+        # A shard without budget left catches up on a later tick
+        activity = self.current
+        if activity is None or self.last.get(shard_id) == activity:
+            self.redundant += 1
+            return False
+
+        sent = self.sent.setdefault(shard_id, deque())
+        while sent and now - sent[0] >= self.period:
+            sent.popleft()
+
+        if len(sent) >= self.budget or (
+            gateway_remaining is not None and gateway_remaining <= self.reserve
+        ):
+            self.deferred += 1
+            self.lagging.add(shard_id)
+            return False
+
+        sent.append(now)
+        self.last[shard_id] = activity
+        self.updates += 1
         return True
@@ -0,0 +1,98 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import sqlite3
+
+from .database import get_connection, retry_when_locked
+
+
+def shard_ranges(shard_count, processes):
+    # Splits the shards into contiguous ranges of almost equal size, one per process
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for process in range(processes):
+        end = start + size + (1 if process < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+
+    return ranges
+
+
+class Lease:
+    def __init__(self, database, name, holder, duration=60):
+        # Leases live in their own database file so that renewing them does not
+        # make the other processes reload their caches
+        self.database = database
+        self.name = name
+        self.holder = holder
+        self.duration = duration
+        conn = get_connection(self.database)
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS 'leases' ('name' TEXT PRIMARY KEY, 'holder'"
+                " TEXT, 'expires' INT);"
+            )
+
+    @retry_when_locked
+    def acquire(self, now):
+        # Takes the lease if it is free or expired, renews it if it is already held
+        # Returns whether this holder owns the lease until now + duration
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO leases ('name', 'holder', 'expires')"
+                    " values(?, ?, ?);",
+                    (self.name, self.holder, now + self.duration),
+                )
+                conn.execute(
+                    "UPDATE leases SET holder = ?, expires = ? WHERE name = ? AND"
+                    " (holder = ? OR expires < ?);",
+                    (self.holder, now + self.duration, self.name, self.holder, now),
+                )
+                result = conn.execute(
+                    "SELECT holder FROM leases WHERE name = ?;", (self.name,)
+                ).fetchall()
+
+            return result[0][0] == self.holder
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def release(self):
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "UPDATE leases SET expires = 0 WHERE name = ? AND holder = ?;",
+                    (self.name, self.holder),
+                )
+
+        except sqlite3.Error as e:
+            return e
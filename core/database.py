@@ -23,104 +23,456 @@ SOFTWARE.
 """
 
 
+import json
 import sqlite3
-from random import randint
+import asyncio
+import threading
+from time import sleep, time
+from collections import OrderedDict
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor
 
 
-def initialize(database):
-    conn = sqlite3.connect(database)
-    cursor = conn.cursor()
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS 'messages' ('message_id' INT, 'channel' INT,"
-        " 'reactionrole_id' INT, 'guild_id' INT);"
-    )
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS 'reactionroles' ('reactionrole_id' INT, 'reaction'"
-        " NVCARCHAR, 'role_id' INT);"
-    )
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'admins' ('role_id' INT, 'guild_id' INT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'cleanup_queue_guilds' ('guild_id' INT, 'unix_timestamp' INT);")
-    cursor.execute("CREATE TABLE IF NOT EXISTS 'dbinfo' ('version' INT);")
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS 'systemchannels' ('guild_id' INT, 'channel_id'"
-        " INT);"
-    )
-    cursor.execute(
-        "CREATE UNIQUE INDEX IF NOT EXISTS guild_id_idx ON systemchannels (guild_id);"
-    )
-    cursor.execute(
-        "CREATE UNIQUE INDEX IF NOT EXISTS guild_id_index ON cleanup_queue_guilds (guild_id);"
+# Connection settings of every database file, see configure()
+_settings = {}
+default_settings = {
+    "synchronous": "NORMAL",
+    "cache_size": -8000,
+    "mmap_size": 67108864,
+    "busy_timeout": 5000,
+    "busy_retries": 3,
+    "cached_statements": 256,
+}
+
+# Every thread keeps one open connection per database file
+_connections = threading.local()
+
+
+def custom_emoji_id(reaction):
+    # Custom emojis are stored as <:name:id> or <a:name:id>, unicode emojis as is
+    if reaction.startswith("<") and reaction.endswith(">"):
+        emoji_id = reaction[:-1].rpartition(":")[2]
+        if emoji_id.isdigit():
+            return int(emoji_id)
+
+    return None
+
+
+def configure(database, settings):
+    # Must be called before the first connection to the database is opened
+    settings = {**default_settings, **settings}
+    for key, value in settings.items():
+        if key != "synchronous":
+            settings[key] = int(value)
+
+    if settings["synchronous"].upper() not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+        settings["synchronous"] = default_settings["synchronous"]
+
+    _settings[database] = settings
+
+
+def get_settings(database):
+    return _settings.get(database, default_settings)
+
+
+def get_connection(database):
+    connections = getattr(_connections, "connections", None)
+    if connections is None:
+        connections = _connections.connections = {}
+
+    conn = connections.get(database)
+    if conn is None:
+        settings = get_settings(database)
+        conn = sqlite3.connect(
+            database,
+            timeout=settings["busy_timeout"] / 1000,
+            cached_statements=settings["cached_statements"],
+        )
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute(f"PRAGMA synchronous = {settings['synchronous']};")
+        conn.execute(f"PRAGMA cache_size = {int(settings['cache_size'])};")
+        conn.execute(f"PRAGMA mmap_size = {int(settings['mmap_size'])};")
+        conn.execute(f"PRAGMA busy_timeout = {int(settings['busy_timeout'])};")
+        connections[database] = conn
+
+    return conn
+
+
+def is_locked(error):
+    return isinstance(error, sqlite3.OperationalError) and (
+        "locked" in str(error) or "busy" in str(error)
     )
-    conn.commit()
-    cursor.close()
-    conn.close()
+
+
+def retry_when_locked(method):
+    # Retries a method a bounded number of times if the database stays locked
+    # for longer than busy_timeout, both raised and returned errors are checked
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        retries = get_settings(self.database)["busy_retries"]
+        for attempt in range(retries + 1):
+            try:
+                result = method(self, *args, **kwargs)
+
+            except sqlite3.OperationalError as e:
+                if not is_locked(e) or attempt == retries:
+                    raise
+
+                result = e
+
+            if not is_locked(result) or attempt == retries:
+                return result
+
+            sleep(0.1 * 2 ** attempt)
+
+        return result
+
+    return wrapper
+
+
+# Database files whose tables were already created by this process
+_initialized = set()
+
+# Tables the in-memory caches are built from and the updates that change them,
+# the other columns of messages are written by every cleanup or edit and left out
+cached_tables = {
+    "messages": "UPDATE OF message_id, reactionrole_id",
+    "reactionroles": "UPDATE",
+    "admins": "UPDATE",
+    "systemchannels": "UPDATE",
+}
+
+
+def initialize(database):
+    if database in _initialized:
+        return
+
+    conn = get_connection(database)
+    with conn:
+        # New tables get the columns added by the schema updates right away because
+        # the CSV migration writes messages before the schema updates run
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'messages' ('message_id' INT, 'channel' INT,"
+            " 'reactionrole_id' INT, 'guild_id' INT, 'last_verified' INT DEFAULT 0,"
+            " 'title' TEXT);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'reactionroles' ('reactionrole_id' INT,"
+            " 'reaction' NVCARCHAR, 'role_id' INT);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'admins' ('role_id' INT, 'guild_id' INT);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'cleanup_queue_guilds' ('guild_id' INT,"
+            " 'unix_timestamp' INT);"
+        )
+        conn.execute("CREATE TABLE IF NOT EXISTS 'dbinfo' ('version' INT);")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'systemchannels' ('guild_id' INT, 'channel_id'"
+            " INT);"
+        )
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS guild_id_idx ON systemchannels"
+            " (guild_id);"
+        )
+        conn.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS guild_id_index ON cleanup_queue_guilds"
+            " (guild_id);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'creation_sessions' ('user_id' INT,"
+            " 'channel_id' INT, 'guild_id' INT, 'step' INT, 'target_channel' INT,"
+            " 'combos' TEXT, 'last_active' INT);"
+        )
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'state' ('key' TEXT PRIMARY KEY, 'value' INT);"
+        )
+        # Allocates reactionrole_ids, AUTOINCREMENT never reuses an ID
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS 'reactionrole_ids' ('reactionrole_id' INTEGER"
+            " PRIMARY KEY AUTOINCREMENT);"
+        )
+        # Counts the changes to the tables the in-memory caches are built from so other
+        # processes do not reload them when only checkpoints or timestamps were written
+        conn.execute("CREATE TABLE IF NOT EXISTS 'cache_version' ('version' INT);")
+        conn.execute(
+            "INSERT INTO cache_version (version) SELECT 0 WHERE NOT EXISTS (SELECT 1"
+            " FROM cache_version);"
+        )
+        for table, update in cached_tables.items():
+            for event in ("INSERT", update, "DELETE"):
+                name = f"{table}_{event.split()[0].lower()}_cache_version"
+                conn.execute(
+                    f"CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}"
+                    " BEGIN UPDATE cache_version SET version = version + 1; END;"
+                )
+
+    _initialized.add(database)
 
 
 class ReactionRoleCreationTracker:
     def __init__(self, guild, database):
         self.database = database
-        initialize(self.database)
-
         self.guild = guild
         self.step = 0
         self.target_channel = None
         self.combos = {}
         self.message_id = None
-        self._generate_reactionrole_id()
-
-    def _generate_reactionrole_id(self):
-        conn = sqlite3.connect(self.database)
-        while True:
-            self.reactionrole_id = randint(0, 100000)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM messages WHERE reactionrole_id = ?;",
-                (self.reactionrole_id,),
-            )
-            already_exists = cursor.fetchall()
-            if already_exists:
-                continue
-            cursor.close()
-            conn.close()
-            break
+        self.title = None
+        self.reactionrole_id = None
 
+    @retry_when_locked
     def commit(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO 'messages' ('message_id', 'channel', 'reactionrole_id',"
-            " 'guild_id') values(?, ?, ?, ?);",
-            (self.message_id, self.target_channel, self.reactionrole_id, self.guild),
-        )
-        for reaction in self.combos:
-            role_id = self.combos[reaction]
-            cursor.execute(
+        conn = get_connection(self.database)
+        with conn:
+            self.reactionrole_id = conn.execute(
+                "INSERT INTO 'reactionrole_ids' DEFAULT VALUES;"
+            ).lastrowid
+            if self.title is None:
+                # Also works on databases the schema updates have not run on yet
+                conn.execute(
+                    "INSERT INTO 'messages' ('message_id', 'channel',"
+                    " 'reactionrole_id', 'guild_id') values(?, ?, ?, ?);",
+                    (self.message_id, self.target_channel, self.reactionrole_id, self.guild),
+                )
+
+            else:
+                conn.execute(
+                    "INSERT INTO 'messages' ('message_id', 'channel',"
+                    " 'reactionrole_id', 'guild_id', 'title') values(?, ?, ?, ?, ?);",
+                    (
+                        self.message_id,
+                        self.target_channel,
+                        self.reactionrole_id,
+                        self.guild,
+                        self.title,
+                    ),
+                )
+            conn.executemany(
                 "INSERT INTO 'reactionroles' ('reactionrole_id', 'reaction', 'role_id')"
                 " values(?, ?, ?);",
-                (self.reactionrole_id, reaction, role_id),
+                [
+                    (self.reactionrole_id, reaction, role_id)
+                    for reaction, role_id in self.combos.items()
+                ],
             )
-        conn.commit()
-        cursor.close()
-        conn.close()
 
 
-class Database:
+class ReactionRoleIndex:
     def __init__(self, database):
+        self.database = database
+        self.messages = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        # Maps every managed message_id to its {reaction: role_id} combos
+        conn = get_connection(self.database)
+        cursor = conn.execute(
+            "SELECT messages.message_id, reactionroles.reaction, reactionroles.role_id"
+            " FROM messages LEFT JOIN reactionroles ON messages.reactionrole_id ="
+            " reactionroles.reactionrole_id;"
+        )
+        messages = {}
+        for message_id, reaction, role_id in cursor:
+            combos = messages.setdefault(message_id, {})
+            if reaction is not None:
+                combos[reaction] = role_id
+
+        self.messages = messages
+
+    def __contains__(self, message_id):
+        return message_id in self.messages
+
+    def get(self, message_id):
+        combos = self.messages.get(message_id)
+        if combos is None:
+            self.misses += 1
+
+        else:
+            self.hits += 1
+
+        return combos
+
+    def set(self, message_id, combos):
+        self.messages[message_id] = dict(combos)
+
+    def add(self, message_id, reaction, role_id):
+        self.messages.setdefault(message_id, {})[reaction] = role_id
+
+    def remove(self, message_id, reaction):
+        combos = self.messages.get(message_id)
+        if combos is not None:
+            combos.pop(reaction, None)
+
+    def discard(self, message_ids):
+        for message_id in message_ids:
+            self.messages.pop(message_id, None)
+
+
+class CreationSessionStore:
+    def __init__(self, ttl, max_sessions):
+        # Creation trackers by (user_id, channel_id), least recently used first
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.last_active = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.evicted_idle = 0
+        self.evicted_capacity = 0
+        self.restored = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __contains__(self, key):
+        if key not in self.sessions:
+            return False
+
+        if time() - self.last_active.get(key, 0) > self.ttl:
+            self.discard(key)
+            self.evicted_idle += 1
+            return False
+
+        return True
+
+    def __getitem__(self, key):
+        tracker = self.sessions[key]
+        with self.lock:
+            # Sessions are read right before being advanced, so every access counts as activity
+            self.last_active[key] = time()
+            self.sessions.move_to_end(key)
+            self.dirty = True
+
+        return tracker
+
+    def __setitem__(self, key, tracker):
+        self.add(key, tracker, time())
+
+    def __delitem__(self, key):
+        self.discard(key)
+
+    def add(self, key, tracker, last_active):
+        with self.lock:
+            while len(self.sessions) >= self.max_sessions:
+                oldest, _ = self.sessions.popitem(last=False)
+                self.last_active.pop(oldest, None)
+                self.evicted_capacity += 1
+
+            self.sessions[key] = tracker
+            self.last_active[key] = last_active
+            self.dirty = True
+
+    def discard(self, key):
+        with self.lock:
+            self.sessions.pop(key, None)
+            self.last_active.pop(key, None)
+            self.dirty = True
+
+    def expire(self):
+        # Evicts the sessions that have been idle for longer than the TTL
+        limit = time() - self.ttl
+        with self.lock:
+            expired = [key for key in self.sessions if self.last_active[key] < limit]
+
+        for key in expired:
+            self.discard(key)
+
+        self.evicted_idle += len(expired)
+        return len(expired)
+
+    def snapshot(self):
+        # Rows of every session as stored in the creation_sessions table
+        with self.lock:
+            self.dirty = False
+            return [
+                (
+                    user,
+                    channel,
+                    tracker.guild,
+                    tracker.step,
+                    tracker.target_channel,
+                    json.dumps(tracker.combos),
+                    round(self.last_active[(user, channel)]),
+                )
+                for (user, channel), tracker in self.sessions.items()
+            ]
+
+
+class GuildSettingsCache:
+    def __init__(self, database):
+        self.database = database
+        self.admins = {}
+        self.systemchannels = {}
+        self.load()
+
+    def load(self):
+        conn = get_connection(self.database)
+        admins = {}
+        result = conn.execute("PRAGMA table_info(admins);").fetchall()
+        # Admins of old databases have no guild yet, they are loaded again once
+        # migrate_admins has assigned them in on_ready
+        if "guild_id" in [value[1] for value in result]:
+            for role_id, guild_id in conn.execute(
+                "SELECT role_id, guild_id FROM admins;"
+            ):
+                admins.setdefault(guild_id, set()).add(role_id)
+
+        self.admins = admins
+        self.systemchannels = dict(
+            conn.execute("SELECT guild_id, channel_id FROM systemchannels;")
+        )
+
+    def get_admins(self, guild_id):
+        return self.admins.get(guild_id, frozenset())
+
+    def add_admin(self, guild_id, role_id):
+        self.admins.setdefault(guild_id, set()).add(role_id)
+
+    def remove_admin(self, guild_id, role_id):
+        self.admins.get(guild_id, set()).discard(role_id)
+
+    def remove_guild(self, guild_id):
+        self.admins.pop(guild_id, None)
+        self.systemchannels.pop(guild_id, None)
+
+
+class Database:
+    def __init__(
+        self,
+        database,
+        session_ttl=900,
+        max_sessions=1000,
+        persist_sessions=False,
+        shard_ids=None,
+        shard_count=None,
+    ):
         self.database = database
         initialize(self.database)
 
-        self.reactionrole_creation = {}
+        # Processes of a cluster only store and restore the sessions of their own shards
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.data_version = None
+        self.cache_version = None
+        self.persist = persist_sessions
+        self.reactionrole_creation = CreationSessionStore(session_ttl, max_sessions)
+        if self.persist:
+            self.restore_sessions()
+
+        self.reaction_index = ReactionRoleIndex(self.database)
+        self.guild_settings = GuildSettingsCache(self.database)
 
     def migrate_admins(self, client):
         import discord
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info(admins);")
-        result = cursor.fetchall()
+        conn = get_connection(self.database)
+        result = conn.execute("PRAGMA table_info(admins);").fetchall()
         columns = [value[1] for value in result]
         if "guild_id" not in columns:
-            cursor.execute("SELECT role_id FROM admins")
-            admins = cursor.fetchall()
+            admins = conn.execute("SELECT role_id FROM admins").fetchall()
             admins2 = []
             for admin in admins:
                 admins2.append(admin[0])
@@ -133,60 +485,60 @@ class Database:
                     if role is not None:
                         guilds[guild.id].append(role.id)
 
-            cursor.execute("ALTER TABLE admins ADD COLUMN 'guild_id' INT;")
-            conn.commit()
-            for guild in guilds:
-                for admin_id in guilds[guild]:
-                    cursor.execute("UPDATE admins SET guild_id = ? WHERE role_id = ?;", (guild, admin_id))
-            conn.commit()
-            cursor.execute("DELETE FROM admins WHERE guild_id IS NULL;")
-            conn.commit()
+            with conn:
+                conn.execute("ALTER TABLE admins ADD COLUMN 'guild_id' INT;")
+                for guild in guilds:
+                    for admin_id in guilds[guild]:
+                        conn.execute(
+                            "UPDATE admins SET guild_id = ? WHERE role_id = ?;",
+                            (guild, admin_id),
+                        )
+                conn.execute("DELETE FROM admins WHERE guild_id IS NULL;")
+
+            self.guild_settings.load()
             print("Successfully migrated admins.")
 
-        cursor.close()
-        conn.close()
-
     def start_creation(self, user, channel, guild):
         tracker = ReactionRoleCreationTracker(guild, self.database)
-        if not f"{user}_{channel}" in self.reactionrole_creation:
-            self.reactionrole_creation[f"{user}_{channel}"] = tracker
+        if not (user, channel) in self.reactionrole_creation:
+            self.reactionrole_creation[(user, channel)] = tracker
             return True
 
         return False
 
     def abort(self, user, channel):
-        if f"{user}_{channel}" in self.reactionrole_creation:
-            del self.reactionrole_creation[f"{user}_{channel}"]
+        if (user, channel) in self.reactionrole_creation:
+            del self.reactionrole_creation[(user, channel)]
             return True
 
         return False
 
     def step(self, user, channel):
-        if f"{user}_{channel}" in self.reactionrole_creation:
-            tracker = self.reactionrole_creation[f"{user}_{channel}"]
+        if (user, channel) in self.reactionrole_creation:
+            tracker = self.reactionrole_creation[(user, channel)]
             return tracker.step
 
         return None
 
     def get_targetchannel(self, user, channel):
-        tracker = self.reactionrole_creation[f"{user}_{channel}"]
+        tracker = self.reactionrole_creation[(user, channel)]
         return tracker.target_channel
 
     def get_combos(self, user, channel):
-        tracker = self.reactionrole_creation[f"{user}_{channel}"]
+        tracker = self.reactionrole_creation[(user, channel)]
         return tracker.combos
 
     def step0(self, user, channel):
-        tracker = self.reactionrole_creation[f"{user}_{channel}"]
+        tracker = self.reactionrole_creation[(user, channel)]
         tracker.step += 1
 
     def step1(self, user, channel, target_channel):
-        tracker = self.reactionrole_creation[f"{user}_{channel}"]
+        tracker = self.reactionrole_creation[(user, channel)]
         tracker.target_channel = target_channel
         tracker.step += 1
 
     def step2(self, user, channel, role=None, reaction=None, done=False):
-        tracker = self.reactionrole_creation[f"{user}_{channel}"]
+        tracker = self.reactionrole_creation[(user, channel)]
         if not done:
             if reaction in tracker.combos:
                 exists = True
@@ -198,393 +550,752 @@ class Database:
         else:
             tracker.step += 1
 
-    def end_creation(self, user, channel, message_id):
-        tracker = self.reactionrole_creation[f"{user}_{channel}"]
+    def end_creation(self, user, channel, message_id, title=None):
+        tracker = self.reactionrole_creation[(user, channel)]
         tracker.message_id = message_id
+        tracker.title = title
         try:
             tracker.commit()
 
         except sqlite3.Error as e:
             return e
 
-        del self.reactionrole_creation[f"{user}_{channel}"]
+        self.reaction_index.set(message_id, tracker.combos)
+        del self.reactionrole_creation[(user, channel)]
+
+    def restore_sessions(self):
+        # Resumes the creation processes that were in progress before a restart
+        conn = get_connection(self.database)
+        clause, parameters = self.owned_sessions()
+        rows = conn.execute(
+            f"SELECT * FROM creation_sessions{clause};", parameters
+        ).fetchall()
+        limit = time() - self.reactionrole_creation.ttl
+        for user, channel, guild, step, target_channel, combos, last_active in rows:
+            if last_active < limit:
+                self.reactionrole_creation.evicted_idle += 1
+                continue
+
+            tracker = ReactionRoleCreationTracker(guild, self.database)
+            tracker.step = step
+            tracker.target_channel = target_channel
+            tracker.combos = json.loads(combos)
+            self.reactionrole_creation.add((user, channel), tracker, last_active)
+            self.reactionrole_creation.restored += 1
+
+        self.reactionrole_creation.dirty = False
+
+    def owned_sessions(self):
+        # WHERE clause selecting the creation sessions of the guilds of this process
+        if not self.shard_ids:
+            return "", ()
+
+        placeholders = ", ".join("?" * len(self.shard_ids))
+        return (
+            f" WHERE ((guild_id >> 22) % ?) IN ({placeholders})",
+            (self.shard_count, *self.shard_ids),
+        )
+
+    @retry_when_locked
+    def persist_sessions(self, rows):
+        # Replaces the stored creation processes with a snapshot of the current ones
+        if not self.persist:
+            return
+
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                clause, parameters = self.owned_sessions()
+                conn.execute(f"DELETE FROM creation_sessions{clause};", parameters)
+                conn.executemany(
+                    "INSERT INTO creation_sessions values(?, ?, ?, ?, ?, ?, ?);", rows
+                )
+
+        except sqlite3.Error as e:
+            return e
+
+    def refresh_caches(self):
+        # Reloads the in-memory caches after another process changed the tables they
+        # are built from, data_version is only a cheap check for any commit at all
+        # Has to run on the writer thread, whose own commits do not change data_version
+        try:
+            conn = get_connection(self.database)
+            version = conn.execute("PRAGMA data_version;").fetchall()[0][0]
+            if version == self.data_version:
+                return False
+
+            self.data_version = version
+            cache_version = conn.execute(
+                "SELECT version FROM cache_version;"
+            ).fetchall()[0][0]
+            if cache_version == self.cache_version:
+                return False
 
+            self.cache_version = cache_version
+            self.reaction_index.load()
+            self.guild_settings.load()
+            return True
+
+        except sqlite3.Error as e:
+            return e
+
+    def get_cached_reactions(self, message_id):
+        # Returns the combos of a managed message without touching the database
+        # or None if the message is not a reaction-role message
+        return self.reaction_index.get(message_id)
+
+    def get_cached_admins(self, guild_id):
+        # Returns the set of admin role IDs of a guild without touching the database
+        return self.guild_settings.get_admins(guild_id)
+
+    def get_cached_systemchannel(self, guild_id):
+        # Returns the system channel ID of a guild or None if it was not set
+        return self.guild_settings.systemchannels.get(guild_id)
+
+    @retry_when_locked
     def exists(self, message_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
+            conn = get_connection(self.database)
+            return conn.execute(
                 "SELECT * FROM messages WHERE message_id = ?;", (message_id,)
-            )
-            result = cursor.fetchall()
-            cursor.close()
-            conn.close()
-            return result
+            ).fetchall()
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def get_reactions(self, message_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT reactionrole_id FROM messages WHERE message_id = ?;",
+            conn = get_connection(self.database)
+            cursor = conn.execute(
+                "SELECT reaction, role_id FROM reactionroles WHERE reactionrole_id ="
+                " (SELECT reactionrole_id FROM messages WHERE message_id = ?);",
                 (message_id,),
             )
-            reactionrole_id = cursor.fetchall()[0][0]
-            cursor.execute(
-                "SELECT reaction, role_id FROM reactionroles WHERE reactionrole_id"
-                " = ?;",
-                (reactionrole_id,),
-            )
             combos = {}
-            for row in cursor:
-                reaction = row[0]
-                role_id = row[1]
+            for reaction, role_id in cursor:
                 combos[reaction] = role_id
 
-            cursor.close()
-            conn.close()
             return combos
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def fetch_messages(self, channel):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT message_id FROM messages WHERE channel = ?;", (channel,)
+            conn = get_connection(self.database)
+            cursor = conn.execute(
+                "SELECT message_id FROM messages WHERE channel = ? ORDER BY message_id;",
+                (channel,),
             )
-            all_messages_in_channel = []
-            for row in cursor:
-                message_id = int(row[0])
-                all_messages_in_channel.append(message_id)
+            return [int(row[0]) for row in cursor]
+
+        except sqlite3.Error as e:
+            return e
 
-            cursor.close()
-            conn.close()
-            return all_messages_in_channel
+    @retry_when_locked
+    def fetch_message_titles(self, channel):
+        # Returns (message_id, title) of the messages of a channel in the order they are numbered
+        try:
+            conn = get_connection(self.database)
+            cursor = conn.execute(
+                "SELECT message_id, title FROM messages WHERE channel = ? ORDER BY"
+                " message_id;",
+                (channel,),
+            )
+            return [(int(row[0]), row[1]) for row in cursor]
 
         except sqlite3.Error as e:
             return e
 
-    def fetch_all_messages(self):
+    @retry_when_locked
+    def get_message_by_number(self, channel, number):
+        # Returns the ID of the n-th message of a channel as listed, or None
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM messages;")
-            all_messages = cursor.fetchall()
+            conn = get_connection(self.database)
+            result = conn.execute(
+                "SELECT message_id FROM messages WHERE channel = ? ORDER BY message_id"
+                " LIMIT 1 OFFSET ?;",
+                (channel, number - 1),
+            ).fetchall()
+            return int(result[0][0]) if result and number > 0 else None
 
-            cursor.close()
-            conn.close()
-            return all_messages
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def set_titles(self, titles):
+        # Stores the (title, message_id) pairs shown when listing messages
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                conn.executemany(
+                    "UPDATE messages SET title = ? WHERE message_id = ?;", titles
+                )
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def fetch_all_messages(self):
+        try:
+            conn = get_connection(self.database)
+            return conn.execute("SELECT * FROM messages;").fetchall()
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def add_guild(self, channel_id, guild_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE messages SET guild_id = ? WHERE channel = ?;",
-                (guild_id, channel_id),
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "UPDATE messages SET guild_id = ? WHERE channel = ?;",
+                    (guild_id, channel_id),
+                )
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def remove_guild(self, guild_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            # Deleting the guilds reaction-role database entries
-            cursor.execute(
-                "SELECT reactionrole_id FROM messages WHERE guild_id = ?;",
-                (guild_id,),
-            )
-            results = cursor.fetchall()
-            if results:
-                for result in results:
-                    reactionrole_id = result[0]
-                    cursor.execute(
-                        "DELETE FROM messages WHERE reactionrole_id = ?;",
-                        (reactionrole_id,),
-                    )
-                    cursor.execute(
-                        "DELETE FROM reactionroles WHERE reactionrole_id = ?;",
-                        (reactionrole_id,),
-                    )
-            # Deleting the guilds systemchannels database entries
-            cursor.execute(
-                "DELETE FROM systemchannels WHERE guild_id = ?;",
-                (guild_id,),
-            )
-            # Delete the guilds admin roles
-            cursor.execute(
-                "DELETE FROM admins WHERE guild_id = ?;",
-                (guild_id,),
-            )
-            # Delete the guilds potencial cleanup_queue entries
-            cursor.execute("DELETE FROM cleanup_queue_guilds WHERE guild_id=?;", (guild_id,))
-            conn.commit()
+            conn = get_connection(self.database)
+            with conn:
+                # Deleting the guilds reaction-role database entries
+                results = conn.execute(
+                    "SELECT message_id FROM messages WHERE guild_id = ?;", (guild_id,)
+                ).fetchall()
+                conn.execute(
+                    "DELETE FROM reactionroles WHERE reactionrole_id IN (SELECT"
+                    " reactionrole_id FROM messages WHERE guild_id = ?);",
+                    (guild_id,),
+                )
+                conn.execute("DELETE FROM messages WHERE guild_id = ?;", (guild_id,))
+                # Deleting the guilds systemchannels database entries
+                conn.execute("DELETE FROM systemchannels WHERE guild_id = ?;", (guild_id,))
+                # Delete the guilds admin roles
+                conn.execute("DELETE FROM admins WHERE guild_id = ?;", (guild_id,))
+                # Delete the guilds potencial cleanup_queue entries
+                conn.execute(
+                    "DELETE FROM cleanup_queue_guilds WHERE guild_id = ?;", (guild_id,)
+                )
 
-            cursor.close()
-            conn.close()
+            self.reaction_index.discard([result[0] for result in results])
+            self.guild_settings.remove_guild(guild_id)
 
         except sqlite3.Error as e:
             return e
-        
+
+    @retry_when_locked
     def delete(self, message_id, guild_id=None):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
+            conn = get_connection(self.database)
             if guild_id:
-                cursor.execute(
+                result = conn.execute(
                     "SELECT reactionrole_id FROM messages WHERE guild_id = ?;",
                     (guild_id,),
-                )
+                ).fetchall()
 
             else:
-                cursor.execute(
+                result = conn.execute(
                     "SELECT reactionrole_id FROM messages WHERE message_id = ?;",
                     (message_id,),
-                )
+                ).fetchall()
 
-            result = cursor.fetchall()
             if result:
                 reactionrole_id = result[0][0]
-                cursor.execute(
-                    "DELETE FROM messages WHERE reactionrole_id = ?;",
-                    (reactionrole_id,),
+                with conn:
+                    deleted_messages = conn.execute(
+                        "SELECT message_id FROM messages WHERE reactionrole_id = ?;",
+                        (reactionrole_id,),
+                    ).fetchall()
+                    conn.execute(
+                        "DELETE FROM messages WHERE reactionrole_id = ?;",
+                        (reactionrole_id,),
+                    )
+                    conn.execute(
+                        "DELETE FROM reactionroles WHERE reactionrole_id = ?;",
+                        (reactionrole_id,),
+                    )
+
+                self.reaction_index.discard([row[0] for row in deleted_messages])
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def delete_messages(self, message_ids=(), channel_id=None):
+        # Deletes reaction-role messages by id or every one of a channel at once
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                if channel_id:
+                    results = conn.execute(
+                        "SELECT message_id, reactionrole_id FROM messages WHERE"
+                        " channel = ?;",
+                        (channel_id,),
+                    ).fetchall()
+
+                else:
+                    placeholders = ", ".join("?" * len(message_ids))
+                    results = conn.execute(
+                        "SELECT message_id, reactionrole_id FROM messages WHERE"
+                        f" message_id IN ({placeholders});",
+                        list(message_ids),
+                    ).fetchall()
+
+                reactionrole_ids = [(result[1],) for result in results]
+                conn.executemany(
+                    "DELETE FROM messages WHERE reactionrole_id = ?;", reactionrole_ids
                 )
-                cursor.execute(
+                conn.executemany(
                     "DELETE FROM reactionroles WHERE reactionrole_id = ?;",
-                    (reactionrole_id,),
+                    reactionrole_ids,
                 )
-                conn.commit()
 
-            cursor.close()
-            conn.close()
+            self.reaction_index.discard([result[0] for result in results])
+            return len(results)
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
+    def remove_role(self, role_id, guild_id):
+        # Removes every reaction-role combination and admin entry of a deleted role
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                results = conn.execute(
+                    "SELECT messages.message_id, reactionroles.reaction FROM"
+                    " reactionroles INNER JOIN messages ON"
+                    " reactionroles.reactionrole_id = messages.reactionrole_id WHERE"
+                    " reactionroles.role_id = ?;",
+                    (role_id,),
+                ).fetchall()
+                conn.execute("DELETE FROM reactionroles WHERE role_id = ?;", (role_id,))
+                conn.execute(
+                    "DELETE FROM admins WHERE role_id = ? AND guild_id = ?;",
+                    (role_id, guild_id),
+                )
+
+            for message_id, reaction in results:
+                self.reaction_index.remove(message_id, reaction)
+
+            self.guild_settings.remove_admin(guild_id, role_id)
+            return len(results)
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def remove_emojis(self, emoji_ids, guild_id):
+        # Removes the combinations of a guild that use one of the deleted custom emojis
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                results = conn.execute(
+                    "SELECT messages.message_id, reactionroles.reactionrole_id,"
+                    " reactionroles.reaction FROM reactionroles INNER JOIN messages ON"
+                    " reactionroles.reactionrole_id = messages.reactionrole_id WHERE"
+                    " messages.guild_id = ? AND reactionroles.reaction LIKE '<%>';",
+                    (guild_id,),
+                ).fetchall()
+                removed = [
+                    result for result in results if custom_emoji_id(result[2]) in emoji_ids
+                ]
+                conn.executemany(
+                    "DELETE FROM reactionroles WHERE reactionrole_id = ? AND"
+                    " reaction = ?;",
+                    [(result[1], result[2]) for result in removed],
+                )
+
+            for message_id, reactionrole_id, reaction in removed:
+                self.reaction_index.remove(message_id, reaction)
+
+            return len(removed)
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def fetch_all_mappings(self):
+        # Returns every reaction-role combination with the guild of its message
+        try:
+            conn = get_connection(self.database)
+            return conn.execute(
+                "SELECT messages.guild_id, messages.message_id,"
+                " reactionroles.reactionrole_id, reactionroles.reaction,"
+                " reactionroles.role_id FROM reactionroles INNER JOIN messages ON"
+                " reactionroles.reactionrole_id = messages.reactionrole_id;"
+            ).fetchall()
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def remove_mappings(self, mappings):
+        # Removes (message_id, reactionrole_id, reaction) combinations in one transaction
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                conn.executemany(
+                    "DELETE FROM reactionroles WHERE reactionrole_id = ? AND"
+                    " reaction = ?;",
+                    [(reactionrole_id, reaction) for _, reactionrole_id, reaction in mappings],
+                )
+
+            for message_id, reactionrole_id, reaction in mappings:
+                self.reaction_index.remove(message_id, reaction)
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
     def add_admin(self, role_id: int, guild_id: int):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO 'admins' ('role_id', 'guild_id') values(?,?);", (role_id, guild_id))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "INSERT INTO 'admins' ('role_id', 'guild_id') values(?,?);",
+                    (role_id, guild_id),
+                )
+
+            self.guild_settings.add_admin(guild_id, role_id)
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def remove_admin(self, role_id: int, guild_id: int):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM admins WHERE role_id = ? AND guild_id = ?;", (role_id, guild_id))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "DELETE FROM admins WHERE role_id = ? AND guild_id = ?;",
+                    (role_id, guild_id),
+                )
+
+            self.guild_settings.remove_admin(guild_id, role_id)
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def get_admins(self, guild_id: int):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("SELECT * FROM admins WHERE guild_id = ?;", (guild_id,))
-            admins = []
-            for row in cursor:
-                role_id = row[0]
-                admins.append(role_id)
-
-            cursor.close()
-            conn.close()
-            return admins
+            conn = get_connection(self.database)
+            cursor = conn.execute(
+                "SELECT role_id FROM admins WHERE guild_id = ?;", (guild_id,)
+            )
+            return [row[0] for row in cursor]
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def add_systemchannel(self, guild_id, channel_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "REPLACE INTO 'systemchannels' ('guild_id', 'channel_id')"
-                " values(?, ?);",
-                (guild_id, channel_id),
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "REPLACE INTO 'systemchannels' ('guild_id', 'channel_id')"
+                    " values(?, ?);",
+                    (guild_id, channel_id),
+                )
+
+            self.guild_settings.systemchannels[guild_id] = channel_id
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def remove_systemchannel(self, guild_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM systemchannels WHERE guild_id = ?;", (guild_id,)
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "DELETE FROM systemchannels WHERE guild_id = ?;", (guild_id,)
+                )
+
+            self.guild_settings.systemchannels.pop(guild_id, None)
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def fetch_systemchannel(self, guild_id):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
+            conn = get_connection(self.database)
+            return conn.execute(
                 "SELECT channel_id FROM systemchannels WHERE guild_id = ?;", (guild_id,)
-            )
-            result = cursor.fetchall()
-            cursor.close()
-            conn.close()
-            return result
+            ).fetchall()
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def fetch_all_guilds(self):
+        # Returns every guild that has reaction-role messages or settings stored
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("SELECT guild_id FROM messages;")
-            message_guilds = cursor.fetchall()
-
-            cursor.execute("SELECT guild_id FROM systemchannels;")
-            systemchannel_guilds = cursor.fetchall()
-
-            cursor.execute("SELECT guild_id FROM admins;")
-            admin_guilds = cursor.fetchall()
-
-            guilds = message_guilds + systemchannel_guilds + admin_guilds
-
-            # Removes any duplicate guilds from the list
-            guilds = list(dict.fromkeys(guilds))
-            guild_ids = []
-            for guild in guilds:
-                if guild[0] is not None:
-                    guild_ids.append(guild[0])
-            
-            cursor.close()
-            conn.close()
-            return guild_ids
+            conn = get_connection(self.database)
+            cursor = conn.execute(
+                "SELECT guild_id FROM messages WHERE guild_id IS NOT NULL UNION"
+                " SELECT guild_id FROM systemchannels WHERE guild_id IS NOT NULL UNION"
+                " SELECT guild_id FROM admins WHERE guild_id IS NOT NULL;"
+            )
+            return [row[0] for row in cursor]
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def add_reaction(self, message_id, role_id, reaction):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT reactionrole_id FROM messages WHERE message_id = ?;",
-                (message_id,),
-            )
-            reactionrole_id = cursor.fetchall()[0][0]
-            cursor.execute(
-                "SELECT * FROM reactionroles WHERE reactionrole_id = ? AND reaction = ?;",
-                (reactionrole_id, reaction)
-            )
-            exists = cursor.fetchall()
-            if exists:
-                cursor.close()
-                conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                # Inserts the combination only if the reaction is not used yet
+                inserted = conn.execute(
+                    "INSERT INTO reactionroles ('reactionrole_id', 'reaction',"
+                    " 'role_id') SELECT reactionrole_id, ?, ? FROM messages WHERE"
+                    " message_id = ? AND NOT EXISTS (SELECT 1 FROM reactionroles"
+                    " WHERE reactionroles.reactionrole_id = messages.reactionrole_id"
+                    " AND reaction = ?);",
+                    (reaction, role_id, message_id, reaction),
+                ).rowcount
+
+            if not inserted:
                 return False
 
-            cursor.execute(
-                "INSERT INTO reactionroles ('reactionrole_id', 'reaction', 'role_id')"
-                " values(?, ?, ?);",
-                (reactionrole_id, reaction, role_id),
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
+            self.reaction_index.add(message_id, reaction, role_id)
             return True
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def remove_reaction(self, message_id, reaction):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT reactionrole_id FROM messages WHERE message_id = ?;",
-                (message_id,),
-            )
-            reactionrole_id = cursor.fetchall()[0][0]
-            cursor.execute(
-                "DELETE FROM reactionroles WHERE reactionrole_id = ? AND reaction = ?;",
-                (reactionrole_id, reaction),
-            )
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "DELETE FROM reactionroles WHERE reactionrole_id IN (SELECT"
+                    " reactionrole_id FROM messages WHERE message_id = ?) AND"
+                    " reaction = ?;",
+                    (message_id, reaction),
+                )
+
+            self.reaction_index.remove(message_id, reaction)
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def add_cleanup_guild(self, guild_id: int, unix_timestamp: int):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("INSERT INTO 'cleanup_queue_guilds' ('guild_id', 'unix_timestamp') values(?,?);", (guild_id, unix_timestamp))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                # Keeps the timestamp of guilds that are already queued
+                conn.execute(
+                    "INSERT OR IGNORE INTO 'cleanup_queue_guilds' ('guild_id',"
+                    " 'unix_timestamp') values(?,?);",
+                    (guild_id, unix_timestamp),
+                )
+
             return True
 
         except sqlite3.Error as e:
             return e
 
+    @retry_when_locked
     def remove_cleanup_guild(self, guild_id: int):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
-            cursor.execute("DELETE FROM cleanup_queue_guilds WHERE guild_id=?;", (guild_id,))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "DELETE FROM cleanup_queue_guilds WHERE guild_id = ?;", (guild_id,)
+                )
+
             return True
 
         except sqlite3.Error as e:
             return e
 
-    def fetch_cleanup_guilds(self, guild_ids_only=False):
+    @retry_when_locked
+    def fetch_cleanup_guilds(self, guild_ids_only=False, queued_before=None):
         try:
-            conn = sqlite3.connect(self.database)
-            cursor = conn.cursor()
+            conn = get_connection(self.database)
+            if queued_before is not None:
+                # Only the guilds that have been queued since before the timestamp
+                cursor = conn.execute(
+                    "SELECT guild_id FROM cleanup_queue_guilds WHERE unix_timestamp"
+                    " <= ?;",
+                    (queued_before,),
+                )
+                return [row[0] for row in cursor]
+
             if guild_ids_only:
-                cursor.execute("SELECT guild_id FROM cleanup_queue_guilds;")
-                guilds = cursor.fetchall()
-                guild_ids = []
-                for guild in guilds:
-                    guild_ids.append(guild[0])
-                guilds = guild_ids
-            else:
-                cursor.execute("SELECT * FROM cleanup_queue_guilds;")
-                guilds = cursor.fetchall()
-            cursor.close()
-            conn.close()
-            return guilds
+                cursor = conn.execute("SELECT guild_id FROM cleanup_queue_guilds;")
+                return [row[0] for row in cursor]
+
+            return conn.execute("SELECT * FROM cleanup_queue_guilds;").fetchall()
 
         except sqlite3.Error as e:
             return e
+
+    @retry_when_locked
+    def fetch_messages_after(self, message_id, limit):
+        # Returns the next messages in message_id order, used to resume long passes
+        try:
+            conn = get_connection(self.database)
+            return conn.execute(
+                "SELECT message_id, channel, guild_id FROM messages WHERE message_id >"
+                " ? ORDER BY message_id LIMIT ?;",
+                (message_id, limit),
+            ).fetchall()
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def fetch_unverified_messages(self, limit):
+        # Returns the messages that were not verified for the longest time
+        try:
+            conn = get_connection(self.database)
+            return conn.execute(
+                "SELECT message_id, channel, reactionrole_id, guild_id FROM messages"
+                " ORDER BY last_verified, message_id LIMIT ?;",
+                (limit,),
+            ).fetchall()
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def mark_verified(self, message_ids, unix_timestamp):
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                conn.executemany(
+                    "UPDATE messages SET last_verified = ? WHERE message_id = ?;",
+                    [(unix_timestamp, message_id) for message_id in message_ids],
+                )
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def count_messages(self):
+        try:
+            conn = get_connection(self.database)
+            return conn.execute("SELECT COUNT(*) FROM messages;").fetchall()[0][0]
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def get_state(self, key, default=None):
+        try:
+            conn = get_connection(self.database)
+            result = conn.execute(
+                "SELECT value FROM state WHERE key = ?;", (key,)
+            ).fetchall()
+            return result[0][0] if result else default
+
+        except sqlite3.Error as e:
+            return e
+
+    @retry_when_locked
+    def set_state(self, key, value):
+        try:
+            conn = get_connection(self.database)
+            with conn:
+                conn.execute(
+                    "REPLACE INTO state ('key', 'value') values(?, ?);", (key, value)
+                )
+
+        except sqlite3.Error as e:
+            return e
+
+
+class AsyncDatabase:
+    # Methods of Database that run SQL, every other attribute is served from memory
+    reads = {
+        "exists",
+        "get_reactions",
+        "fetch_messages",
+        "fetch_message_titles",
+        "get_message_by_number",
+        "fetch_all_messages",
+        "get_admins",
+        "fetch_systemchannel",
+        "fetch_all_guilds",
+        "fetch_cleanup_guilds",
+        "fetch_unverified_messages",
+        "fetch_messages_after",
+        "count_messages",
+        "get_state",
+        "fetch_all_mappings",
+    }
+    writes = {
+        "migrate_admins",
+        "start_creation",
+        "end_creation",
+        "add_guild",
+        "remove_guild",
+        "delete",
+        "delete_messages",
+        "remove_role",
+        "remove_emojis",
+        "remove_mappings",
+        "set_titles",
+        "add_admin",
+        "remove_admin",
+        "add_systemchannel",
+        "remove_systemchannel",
+        "add_reaction",
+        "remove_reaction",
+        "add_cleanup_guild",
+        "remove_cleanup_guild",
+        "persist_sessions",
+        "refresh_caches",
+        "mark_verified",
+        "set_state",
+    }
+
+    def __init__(self, database, readers=2, **options):
+        # Writes are serialized on a single thread, reads share a small pool
+        # so that no query is ever executed on the event loop
+        self.db = Database(database, **options)
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+        self.reader = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="db-reader"
+        )
+
+    def __getattr__(self, name):
+        attr = getattr(self.db, name)
+        if name in self.writes:
+            executor = self.writer
+
+        elif name in self.reads:
+            executor = self.reader
+
+        else:
+            return attr
+
+        def call(*args, **kwargs):
+            return self._run(executor, attr, *args, **kwargs)
+
+        return call
+
+    def _run(self, executor, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    def run_read(self, func, *args, **kwargs):
+        return self._run(self.reader, func, *args, **kwargs)
+
+    def run_write(self, func, *args, **kwargs):
+        return self._run(self.writer, func, *args, **kwargs)
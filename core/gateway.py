@@ -0,0 +1,50 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+REACTION_EVENTS = ("MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE")
+
+
+class ReactionGatewayFilter:
+    def __init__(self, is_managed):
+        # is_managed receives a message ID and tells if reactions to it matter
+        self.is_managed = is_managed
+        self.passed = 0
+        self.dropped = 0
+
+    def wrap(self, parser):
+        def parse(data):
+            if self.is_managed(int(data["message_id"])):
+                self.passed += 1
+                return parser(data)
+
+            self.dropped += 1
+
+        return parse
+
+    def install(self, parsers):
+        # Wraps the gateway parsers of the client connection state, events that
+        # are dropped never become event objects or dispatched coroutines
+        for event in REACTION_EVENTS:
+            parsers[event] = self.wrap(parsers[event])
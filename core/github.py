@@ -23,25 +23,110 @@ SOFTWARE.
 """
 
 
-from urllib.request import urlopen
 
+import asyncio
 
-def get_latest():
-    # Get latest version string from GitHub
-    data = urlopen(
-        "https://raw.githubusercontent.com/Scuwr/reaction-light/master/.version"
-    )
-    for line in data:
-        latest = line.decode()
-        break
+import aiohttp
 
-    return latest.rstrip("\n").rstrip("\r")
 
+LATEST_VERSION_URL = (
+    "https://raw.githubusercontent.com/Scuwr/reaction-light/master/.version"
+)
 
-def check_for_updates(version):
-    # Get latest version from GitHub repo and checks it against the current one
-    latest = get_latest()
-    if latest > version:
-        return latest
 
-    return False
+def parse_version(version):
+    # Turns "2.10.1" (or "v2.10.1-beta") into (2, 10, 1) so versions compare numerically
+    parts = []
+    for part in version.strip().lstrip("v").split("."):
+        digits = ""
+        for character in part:
+            if not character.isdigit():
+                break
+
+            digits += character
+
+        parts.append(int(digits) if digits else 0)
+
+    return tuple(parts)
+
+
+def is_newer(latest, version):
+    return parse_version(latest) > parse_version(version)
+
+
+class UpdateChecker:
+    def __init__(self, url=LATEST_VERSION_URL, timeout=10, max_age=3600, offline=False):
+        # The latest version is requested at most once every max_age seconds
+        # and reused by every caller in between
+        self.url = url
+        self.timeout = timeout
+        self.max_age = max_age
+        self.offline = offline
+        self.latest = None
+        self.checked = None
+        self.etag = None
+        self.last_modified = None
+        self.error = None
+        self._lock = None
+
+    def fresh(self):
+        loop = asyncio.get_event_loop()
+        return self.checked is not None and loop.time() - self.checked < self.max_age
+
+    async def get_latest(self, force=False):
+        # Returns the latest version string, None if it could never be fetched
+        if self.offline or (self.fresh() and not force):
+            return self.latest
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self.fresh() and not force:
+                # Another caller fetched it while this one was waiting
+                return self.latest
+
+            await self._fetch()
+            self.checked = asyncio.get_event_loop().time()
+
+        return self.latest
+
+    async def _fetch(self):
+        # Conditional request, GitHub answers 304 without a body if nothing changed
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        try:
+            async with aiohttp.ClientSession(timeout=timeout) as session:
+                async with session.get(self.url, headers=headers) as response:
+                    if response.status == 304:
+                        self.error = None
+                        return
+
+                    if response.status != 200:
+                        self.error = f"HTTP {response.status}"
+                        return
+
+                    text = await response.text()
+                    lines = text.splitlines()
+                    self.latest = lines[0].strip() if lines else self.latest
+                    self.etag = response.headers.get("ETag")
+                    self.last_modified = response.headers.get("Last-Modified")
+                    self.error = None
+
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # The previous result stays valid until the next attempt
+            self.error = e
+
+    async def check_for_updates(self, version):
+        # Returns the latest version if it is newer than the current one
+        latest = await self.get_latest()
+        if latest and is_newer(latest, version):
+            return latest
+
+        return False
@@ -36,6 +36,7 @@ def migrate():
     if "id.csv" not in files:
         return False
     else:
+        database.initialize(f"{folder}/reactionlight.db")
         for file in os.listdir(folder):
             if (
                 file.endswith(".csv")
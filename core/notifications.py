@@ -0,0 +1,130 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+import asyncio
+from collections import deque
+
+
+class NotificationDispatcher:
+    def __init__(self, window, send, budget=5, period=60, limit=2000, max_backlog=50):
+        # send is a coroutine function receiving (channel_id, text)
+        # channel_id None stands for the console and has no send budget
+        self.window = window
+        self.send = send
+        self.budget = budget
+        self.period = period
+        self.limit = limit
+        self.max_backlog = max_backlog
+        self.pending = {}
+        self.backlog = {}
+        self.sent = {}
+        self.scheduled = set()
+        self.delivering = set()
+        self.received = 0
+        self.deduplicated = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def notify(self, channel_id, text):
+        # Identical notices to a channel within the window are sent once with a count
+        self.received += 1
+        notices = self.pending.setdefault(channel_id, {})
+        if text in notices:
+            self.deduplicated += 1
+
+        notices[text] = notices.get(text, 0) + 1
+        self._schedule(channel_id, self.window)
+
+    def digest(self, notices):
+        # Packs the notices into as few messages of at most limit characters as possible
+        chunks = []
+        current = ""
+        for text, count in notices.items():
+            if count > 1:
+                text = f"{text}\n*(repeated {count} times)*"
+
+            for start in range(0, len(text), self.limit):
+                part = text[start : start + self.limit]
+                if current and len(current) + len(part) + 2 <= self.limit:
+                    current = f"{current}\n\n{part}"
+
+                else:
+                    if current:
+                        chunks.append(current)
+
+                    current = part
+
+        if current:
+            chunks.append(current)
+
+        return chunks
+
+    def _schedule(self, channel_id, delay):
+        if channel_id not in self.scheduled:
+            self.scheduled.add(channel_id)
+            asyncio.get_event_loop().call_later(delay, self._flush, channel_id)
+
+    def _flush(self, channel_id):
+        self.scheduled.discard(channel_id)
+        if channel_id in self.delivering:
+            # Wait for the previous digest of this channel to be sent to keep notices ordered
+            self._schedule(channel_id, self.window)
+            return
+
+        self.delivering.add(channel_id)
+        asyncio.ensure_future(self._deliver(channel_id))
+
+    async def _deliver(self, channel_id):
+        backlog = self.backlog.setdefault(channel_id, deque())
+        backlog.extend(self.digest(self.pending.pop(channel_id, {})))
+        while len(backlog) > self.max_backlog:
+            backlog.popleft()
+            self.dropped += 1
+
+        sent = self.sent.setdefault(channel_id, deque())
+        now = asyncio.get_event_loop().time()
+        while sent and now - sent[0] >= self.period:
+            sent.popleft()
+
+        try:
+            while backlog and (channel_id is None or len(sent) < self.budget):
+                text = backlog.popleft()
+                if channel_id is not None:
+                    sent.append(now)
+
+                await self.send(channel_id, text)
+                self.delivered += 1
+
+        finally:
+            self.delivering.discard(channel_id)
+            if backlog:
+                # The rest is sent once the oldest message leaves the budget period
+                self._schedule(channel_id, max(self.window, self.period - (now - sent[0])))
+
+            else:
+                del self.backlog[channel_id]
+                if not sent:
+                    del self.sent[channel_id]
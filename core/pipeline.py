@@ -0,0 +1,181 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import asyncio
+from time import perf_counter
+
+
+class StageStats:
+    def __init__(self):
+        self.processed = 0
+        self.dropped = 0
+        # Items dropped per guild, only counted by guild fair stages
+        self.guild_dropped = {}
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def record(self, latency):
+        self.processed += 1
+        self.total_latency += latency
+        if latency > self.max_latency:
+            self.max_latency = latency
+
+    @property
+    def average_latency(self):
+        return self.total_latency / self.processed if self.processed else 0.0
+
+
+class GuildFairQueue:
+    def __init__(self, maxsize):
+        # Every guild gets its own bounded queue, guilds with pending items are
+        # served round-robin and never by two workers at the same time
+        self.maxsize = maxsize
+        self.queues = {}
+        # Guilds that are waiting in ready or being served by a worker
+        self.scheduled = set()
+        # Number of put calls waiting for room in the queue of a guild
+        self.waiting = {}
+        self.ready = asyncio.Queue()
+
+    def qsize(self):
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def full(self, guild_id):
+        queue = self.queues.get(guild_id)
+        return queue is not None and queue.full()
+
+    def _queue(self, guild_id):
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = self.queues[guild_id] = asyncio.Queue(self.maxsize)
+
+        return queue
+
+    def _schedule(self, guild_id):
+        if guild_id not in self.scheduled:
+            self.scheduled.add(guild_id)
+            self.ready.put_nowait(guild_id)
+
+    def _unschedule(self, guild_id):
+        # Queues with waiting put calls are kept so their items are not lost
+        self.scheduled.discard(guild_id)
+        if guild_id not in self.waiting:
+            del self.queues[guild_id]
+
+    async def put(self, item):
+        guild_id = item[0]
+        queue = self._queue(guild_id)
+        self.waiting[guild_id] = self.waiting.get(guild_id, 0) + 1
+        try:
+            await queue.put(item)
+
+        finally:
+            self.waiting[guild_id] -= 1
+            if not self.waiting[guild_id]:
+                del self.waiting[guild_id]
+
+        self._schedule(guild_id)
+
+    def put_nowait(self, item):
+        guild_id = item[0]
+        self._queue(guild_id).put_nowait(item)
+        self._schedule(guild_id)
+
+    async def get(self):
+        while True:
+            guild_id = await self.ready.get()
+            queue = self.queues[guild_id]
+            if not queue.empty():
+                return queue.get_nowait()
+
+            self._unschedule(guild_id)
+
+    def task_done(self, item):
+        # Puts the guild at the back of the round-robin once its item is processed
+        guild_id = item[0]
+        queue = self.queues[guild_id]
+        if queue.empty():
+            self._unschedule(guild_id)
+
+        else:
+            self.ready.put_nowait(guild_id)
+
+
+class Stage:
+    def __init__(self, name, handler, maxsize, workers=1, guild_fair=False):
+        # Items of guild fair stages must be tuples starting with the guild ID
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.guild_fair = guild_fair
+        self.queue = GuildFairQueue(maxsize) if guild_fair else asyncio.Queue(maxsize)
+        self.stats = StageStats()
+        self.tasks = []
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def put_nowait(self, item):
+        # Drops the item if the stage is full instead of holding the caller
+        try:
+            self.queue.put_nowait(item)
+            return True
+
+        except asyncio.QueueFull:
+            self.stats.dropped += 1
+            if self.guild_fair:
+                guild_dropped = self.stats.guild_dropped
+                guild_dropped[item[0]] = guild_dropped.get(item[0], 0) + 1
+
+            return False
+
+    async def put(self, item):
+        await self.queue.put(item)
+
+    def start(self):
+        if not self.tasks:
+            for _ in range(self.workers):
+                self.tasks.append(asyncio.ensure_future(self._work()))
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+
+        self.tasks = []
+
+    async def _work(self):
+        while True:
+            item = await self.queue.get()
+            start = perf_counter()
+            try:
+                await self.handler(item)
+
+            except Exception as e:
+                print(f"Unhandled error in the {self.name} stage:\n{e!r}")
+
+            finally:
+                self.stats.record(perf_counter() - start)
+                if self.guild_fair:
+                    self.queue.task_done(item)
@@ -0,0 +1,78 @@
+"""
+MIT License
+
+Copyright (c) 2019-2021 Scuwr
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import asyncio
+
+
+class RoleChangeCoalescer:
+    def __init__(self, window, apply):
+        # apply is a coroutine function receiving (guild_id, member_id, changes)
+        # where changes maps role IDs to True (add) or False (remove)
+        self.window = window
+        self.apply = apply
+        self.pending = {}
+        self.waiters = {}
+        self.applying = set()
+        self.submitted = 0
+        self.flushed = 0
+
+    def submit(self, guild_id, member_id, role_id, add):
+        # Returns a future that is done once the edit containing this change ran,
+        # its result tells if the edit was applied
+        key = (guild_id, member_id)
+        loop = asyncio.get_event_loop()
+        self.submitted += 1
+        changes = self.pending.get(key)
+        if changes is None:
+            changes = self.pending[key] = {}
+            self.waiters[key] = loop.create_future()
+            loop.call_later(self.window, self._flush, key)
+
+        # The last toggle of a role within the window wins
+        changes[role_id] = add
+        return self.waiters[key]
+
+    def _flush(self, key):
+        if key in self.applying:
+            # Wait for the previous edit of this member to finish to keep changes ordered
+            asyncio.get_event_loop().call_later(self.window, self._flush, key)
+            return
+
+        changes = self.pending.pop(key, None)
+        done = self.waiters.pop(key, None)
+        if changes:
+            self.applying.add(key)
+            asyncio.ensure_future(self._apply(key, changes, done))
+
+    async def _apply(self, key, changes, done):
+        applied = False
+        try:
+            self.flushed += 1
+            applied = await self.apply(key[0], key[1], changes)
+
+        finally:
+            self.applying.discard(key)
+            if done is not None and not done.done():
+                done.set_result(bool(applied))
@@ -25,6 +25,38 @@ SOFTWARE.
 
 import sqlite3
 
+from .database import get_connection
+
+
+# Queries run on every reaction, message or cleanup that must never scan a table
+hot_queries = [
+    ("SELECT * FROM messages WHERE message_id = ?;", (0,)),
+    (
+        "SELECT reaction, role_id FROM reactionroles WHERE reactionrole_id ="
+        " (SELECT reactionrole_id FROM messages WHERE message_id = ?);",
+        (0,),
+    ),
+    (
+        "SELECT message_id, title FROM messages WHERE channel = ? ORDER BY"
+        " message_id;",
+        (0,),
+    ),
+    (
+        "SELECT message_id FROM messages WHERE channel = ? ORDER BY message_id LIMIT"
+        " 1 OFFSET ?;",
+        (0, 0),
+    ),
+    ("SELECT message_id FROM messages WHERE guild_id = ?;", (0,)),
+    ("DELETE FROM messages WHERE reactionrole_id = ?;", (0,)),
+    ("DELETE FROM reactionroles WHERE reactionrole_id = ?;", (0,)),
+    ("SELECT role_id FROM admins WHERE guild_id = ?;", (0,)),
+    (
+        "SELECT message_id, channel, reactionrole_id, guild_id FROM messages ORDER BY"
+        " last_verified, message_id LIMIT ?;",
+        (0,),
+    ),
+]
+
 
 class SchemaHandler:
     def __init__(self, database):
@@ -32,12 +64,8 @@ class SchemaHandler:
         self.version = self.version_check()
 
     def version_check(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("SELECT version FROM dbinfo;")
-        version = cursor.fetchall()
-        cursor.close()
-        conn.close()
+        conn = get_connection(self.database)
+        version = conn.execute("SELECT version FROM dbinfo;").fetchall()
         if not version:
             self.set_version(0)
             return 0
@@ -49,33 +77,163 @@ class SchemaHandler:
         if self.version == 0:
             self.zero_to_one()
 
+        if self.version == 1:
+            self.one_to_two()
+
+        if self.version == 2:
+            self.two_to_three()
+
+        if self.version == 3:
+            self.three_to_four()
+
+        if self.version == 4:
+            self.four_to_five()
+
     def set_version(self, version):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        if version > 0:
-            previous = version - 1
-            cursor.execute(
-                "UPDATE dbinfo SET version = ? WHERE version = ?;", (version, previous)
-            )
+        conn = get_connection(self.database)
+        with conn:
+            if version > 0:
+                previous = version - 1
+                conn.execute(
+                    "UPDATE dbinfo SET version = ? WHERE version = ?;", (version, previous)
+                )
 
-        else:
-            cursor.execute("INSERT INTO dbinfo(version) values(?);", (version,))
+            else:
+                conn.execute("INSERT INTO dbinfo(version) values(?);", (version,))
 
-        conn.commit()
-        cursor.close()
-        conn.close()
         self.version = version
 
     def zero_to_one(self):
-        conn = sqlite3.connect(self.database)
-        cursor = conn.cursor()
-        cursor.execute("PRAGMA table_info(messages);")
-        result = cursor.fetchall()
+        conn = get_connection(self.database)
+        result = conn.execute("PRAGMA table_info(messages);").fetchall()
         columns = [value[1] for value in result]
         if "guild_id" not in columns:
-            cursor.execute("ALTER TABLE messages ADD COLUMN 'guild_id' INT;")
-            conn.commit()
+            with conn:
+                conn.execute("ALTER TABLE messages ADD COLUMN 'guild_id' INT;")
 
-        cursor.close()
-        conn.close()
         self.set_version(1)
+
+    def one_to_two(self):
+        conn = get_connection(self.database)
+        duplicates = conn.execute(
+            "SELECT COUNT(*) FROM messages WHERE rowid NOT IN (SELECT MIN(rowid) FROM"
+            " messages GROUP BY message_id);"
+        ).fetchall()[0][0]
+        orphans = conn.execute(
+            "SELECT COUNT(*) FROM reactionroles WHERE NOT EXISTS (SELECT 1 FROM"
+            " messages WHERE messages.reactionrole_id = reactionroles.reactionrole_id);"
+        ).fetchall()[0][0]
+        if duplicates or orphans:
+            # Keeps a copy of the database like rl!update does before deleting rows,
+            # the backup API also includes the commits still in the WAL file
+            backup = sqlite3.connect(f"{self.database}.bak")
+            with backup:
+                conn.backup(backup)
+
+            backup.close()
+            print(
+                f"Removing {duplicates} duplicated message rows and {orphans} reaction"
+                f" rows of deleted messages, a backup is in {self.database}.bak"
+            )
+
+        with conn:
+            # Duplicated message rows would break the unique index, the first one is kept
+            conn.execute(
+                "DELETE FROM messages WHERE rowid NOT IN (SELECT MIN(rowid) FROM"
+                " messages GROUP BY message_id);"
+            )
+            conn.execute(
+                "DELETE FROM reactionroles WHERE NOT EXISTS (SELECT 1 FROM messages"
+                " WHERE messages.reactionrole_id = reactionroles.reactionrole_id);"
+            )
+            conn.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS messages_message_id_idx ON messages"
+                " (message_id);"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_channel_idx ON messages (channel);"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_guild_id_idx ON messages"
+                " (guild_id);"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_reactionrole_id_idx ON messages"
+                " (reactionrole_id);"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS reactionroles_reactionrole_id_idx ON"
+                " reactionroles (reactionrole_id);"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS admins_guild_id_idx ON admins (guild_id);"
+            )
+
+        self.set_version(2)
+
+    def two_to_three(self):
+        conn = get_connection(self.database)
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS 'reactionrole_ids' ('reactionrole_id'"
+                " INTEGER PRIMARY KEY AUTOINCREMENT);"
+            )
+            # Reserves the IDs of existing reaction-role messages so they are never reallocated
+            conn.execute(
+                "INSERT OR IGNORE INTO reactionrole_ids (reactionrole_id) SELECT"
+                " reactionrole_id FROM messages WHERE reactionrole_id IS NOT NULL UNION"
+                " SELECT reactionrole_id FROM reactionroles WHERE reactionrole_id IS"
+                " NOT NULL;"
+            )
+
+        self.set_version(3)
+
+    def three_to_four(self):
+        conn = get_connection(self.database)
+        result = conn.execute("PRAGMA table_info(messages);").fetchall()
+        columns = [value[1] for value in result]
+        with conn:
+            if "last_verified" not in columns:
+                # Unix timestamp of the last time the cleanup found the message on Discord
+                conn.execute(
+                    "ALTER TABLE messages ADD COLUMN 'last_verified' INT DEFAULT 0;"
+                )
+
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_last_verified_idx ON messages"
+                " (last_verified, message_id);"
+            )
+
+        self.set_version(4)
+
+    def four_to_five(self):
+        conn = get_connection(self.database)
+        result = conn.execute("PRAGMA table_info(messages);").fetchall()
+        columns = [value[1] for value in result]
+        with conn:
+            if "title" not in columns:
+                # Embed title or content shown when listing the messages of a channel
+                conn.execute("ALTER TABLE messages ADD COLUMN 'title' TEXT;")
+
+            # Messages are numbered by their ID within a channel
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS messages_channel_message_id_idx ON messages"
+                " (channel, message_id);"
+            )
+            conn.execute("DROP INDEX IF EXISTS messages_channel_idx;")
+
+        self.set_version(5)
+
+    def check_query_plans(self):
+        # Returns the hot queries that SQLite would answer with a full table scan
+        conn = get_connection(self.database)
+        scans = []
+        for query, parameters in hot_queries:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {query}", parameters).fetchall()
+            for row in plan:
+                detail = row[-1]
+                # Walking an index in order is fine, only full table scans are reported
+                if detail.startswith("SCAN") and "INDEX" not in detail:
+                    scans.append((query, detail))
+
+        return scans